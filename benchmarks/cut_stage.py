@@ -0,0 +1,200 @@
+# Offline benchmark of the cut stage on synthetic books.
+#
+#   python benchmarks/cut_stage.py --pages 40 --dpi 600 --cores 1 4 8 --compression zlib
+#
+# Generates two-page tif spreads, runs process_images with each INSPECTION_CLIENT_MAX_CORES value
+# and reports pages/s, the peak RSS of all workers together during that run and where the time goes inside
+# a single page.
+
+import os
+import sys
+import time
+import shutil
+import threading
+import argparse
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+os.environ.setdefault("INSPECTION_CLIENT_TEMP_IMAGE_SIZE", "2000")
+os.environ.setdefault("INSPECTION_CLIENT_GRID_SIZE", "10")
+os.environ.setdefault("INSPECTION_CLIENT_MAX_CORES", str(os.cpu_count()))
+
+import cv2
+import numpy as np
+import tifffile
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PAGE_WIDTH_INCHES = 6.0
+PAGE_HEIGHT_INCHES = 9.0
+
+def make_page(width, height, rng):
+    page = np.full((height, width), 235, dtype=np.uint8)
+
+    # lines of "text": short dark blocks with a bit of blur, like print seen by the scanner
+    line_height = max(height // 60, 4)
+    for y in range(height // 12, height - height // 12, line_height * 2):
+        x = width // 10
+        while x < width - width // 10:
+            word = int(rng.integers(line_height, line_height * 6))
+            cv2.rectangle(page, (x, y), (min(x + word, width - width // 10), y + line_height), int(rng.integers(10, 60)), -1)
+            x += word + line_height
+    page = cv2.GaussianBlur(page, (3, 3), 0)
+
+    noise = rng.normal(0, 4, page.shape)
+    return np.clip(page + noise, 0, 255).astype(np.uint8)
+
+def make_spread(dpi, margin, skew, rng):
+    page_width = int(PAGE_WIDTH_INCHES * dpi)
+    page_height = int(PAGE_HEIGHT_INCHES * dpi)
+    margin = int(margin * dpi)
+
+    # dark scanner bed around the two pages
+    spread = np.full((page_height + 2 * margin, 2 * page_width + 2 * margin), 20, dtype=np.uint8)
+    spread[margin:margin + page_height, margin:margin + page_width] = make_page(page_width, page_height, rng)
+    spread[margin:margin + page_height, margin + page_width:margin + 2 * page_width] = make_page(page_width, page_height, rng)
+
+    if skew:
+        angle = float(rng.uniform(-skew, skew))
+        rows, cols = spread.shape
+        matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1.0)
+        spread = cv2.warpAffine(spread, matrix, (cols, rows), borderValue=20)
+
+    return spread
+
+def generate_book(path, pages, dpi, margin, skew, compression, seed=0):
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(pages):
+        spread = make_spread(dpi, margin, skew, rng)
+        tifffile.imwrite(os.path.join(path, f'{i:04d}_Main_frame.tif'), spread, compression=compression, resolution=(dpi, dpi))
+
+# samples the summed rss of this process's children (the pool workers) while a run is going on
+class WorkersPeakRss:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        parent = psutil.Process()
+        while not self.stopped.is_set():
+            total = 0
+            for child in parent.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    pass  # exited between listing and reading
+            self.peak = max(self.peak, total)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        if psutil is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def peak_mb(self):
+        return self.peak / (1024 * 1024) if psutil is not None else float('nan')
+
+# seconds and the peak rss in MB of the workers of this run only
+def run_cut(book_path, temp_path, cores):
+    from resources import utils, worker_pool
+
+    os.environ["INSPECTION_CLIENT_MAX_CORES"] = str(cores)
+    worker_pool.shutdown_pool()
+
+    with WorkersPeakRss() as rss:
+        start = time.perf_counter()
+        utils.process_images(book_path, temp_path, incremental=False)
+        elapsed = time.perf_counter() - start
+        worker_pool.shutdown_pool()
+    return elapsed, rss.peak_mb()
+
+def stage_split(book_path, samples, tolerance):
+    from resources import utils
+    from resources.tiff_reader import read_tiff_with_retry
+
+    square_size = int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"))
+    levels = utils.boundary_pyramid_levels(tolerance)
+    timings = {'decode': 0.0, 'boundary': 0.0, 'resize': 0.0, 'png encode': 0.0}
+    max_error = 0
+
+    filenames = utils.list_source_images(book_path)[:samples]
+    for filename in filenames:
+        start = time.perf_counter()
+        image = read_tiff_with_retry(os.path.join(book_path, filename))
+        timings['decode'] += time.perf_counter() - start
+
+        for half in utils.split_image(image):
+            start = time.perf_counter()
+            if levels > 0:
+                x, y, w, h = utils.find_page_bounds_coarse(half, levels)
+            else:
+                x, y, w, h = utils.find_page_bounds(half)
+            timings['boundary'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            resized = cv2.resize(half[y:y+h, x:x+w], (square_size, square_size))
+            timings['resize'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            cv2.imencode('.png', resized)
+            timings['png encode'] += time.perf_counter() - start
+
+            if levels > 0:
+                max_error = max(max_error, utils.compare_page_bounds(half, tolerance)[1])
+
+    return timings, len(filenames), max_error
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cut stage on synthetic books.')
+    parser.add_argument('--pages', type=int, default=20, help='number of spreads in the book')
+    parser.add_argument('--dpi', type=int, default=600)
+    parser.add_argument('--margin', type=float, default=0.4, help='scanner bed around the pages, in inches')
+    parser.add_argument('--skew', type=float, default=0.5, help='maximum rotation of a spread, in degrees')
+    parser.add_argument('--compression', default=None, help='tif compression, e.g. zlib, lzw, packbits')
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--samples', type=int, default=3, help='pages used for the per stage split')
+    parser.add_argument('--tolerance', type=int, default=int(os.getenv("INSPECTION_CLIENT_BOUNDARY_TOLERANCE", "0")))
+    parser.add_argument('--keep', action='store_true', help='keep the generated book and temp images')
+    args = parser.parse_args()
+
+    os.environ["INSPECTION_CLIENT_BOUNDARY_TOLERANCE"] = str(args.tolerance)
+
+    work_dir = tempfile.mkdtemp(prefix='cut_benchmark_')
+    book_path = os.path.join(work_dir, 'book')
+    temp_path = os.path.join(work_dir, 'temp_images')
+
+    try:
+        start = time.perf_counter()
+        generate_book(book_path, args.pages, args.dpi, args.margin, args.skew, args.compression)
+        print(f'generated {args.pages} spreads at {args.dpi} dpi in {time.perf_counter() - start:.1f}s ({work_dir})')
+
+        print(f'{"cores":>6} {"seconds":>9} {"pages/s":>9} {"peak rss MB":>12}')
+        for cores in args.cores:
+            elapsed, peak_rss = run_cut(book_path, temp_path, cores)
+            print(f'{cores:>6} {elapsed:>9.2f} {2 * args.pages / elapsed:>9.2f} {peak_rss:>12.0f}')
+
+        timings, samples, max_error = stage_split(book_path, args.samples, args.tolerance)
+        total = sum(timings.values())
+        print(f'single page split over {samples} spreads (tolerance {args.tolerance}px):')
+        for stage, seconds in timings.items():
+            print(f'{stage:>12} {1000 * seconds / max(samples, 1):>9.1f} ms/spread {100 * seconds / total:>6.1f}%')
+        if args.tolerance > 0:
+            print(f'max coarse boundary error: {max_error}px')
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,11 @@ def main():
     )
     initialize_db()
     LoggerSingleton().start_listener()  # Start the logging listener process
+
+    # loads and warms the blur model in its own process while the ui comes up
+    from resources.blur_service import start_service, stop_service
+    start_service()
+
     app = QApplication(sys.argv)
 
     stacked_widget = QStackedWidget()
@@ -68,7 +73,13 @@ def main():
 
     stacked_widget.show()
 
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+
+    from resources.worker_pool import shutdown_pool
+    shutdown_pool()
+    stop_service()
+
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
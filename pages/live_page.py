@@ -5,6 +5,7 @@ from time import sleep
 import os
 from pages.point_report_window import PointReportWindow
 from resources.live_handler import LiveHandler
+from resources.presets import list_presets
 
 next_num_page = '0'
 recent_half_paths = []
@@ -94,11 +95,8 @@ class LivePage(QWidget):
         self.setLayout(layout)
 
     def load_presets(self):
-        presets_folder = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets')
-        if os.path.exists(presets_folder):
-            for file_name in os.listdir(presets_folder):
-                if file_name.endswith('.pkl'):
-                    self.preset_combo.addItem(file_name)
+        for preset_name in list_presets():
+            self.preset_combo.addItem(preset_name)
 
     def select_folder_action(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -135,7 +133,11 @@ class LivePage(QWidget):
         
         self.selected_preset = self.preset_combo.currentText()
         
-        self.live_handler = LiveHandler(self.selected_preset)
+        try:
+            self.live_handler = LiveHandler(self.selected_preset)
+        except Exception as e:
+            self.update_label.setText(f'Cannot use preset: {e}')
+            return
     
         self.start_btn.setText('Stop Watching')
         self.start_btn.setStyleSheet("""
@@ -1,22 +1,25 @@
 import sys
 import os
+import threading
 from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QComboBox, QTableWidgetItem, QListWidgetItem, QPushButton, QFileDialog, QListWidget, QMenu, QApplication
 from PyQt5.QtCore import QThread, pyqtSignal, Qt, pyqtSlot
 from PyQt5.QtGui import QColor
 
 from queue import Queue
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 #from resources import utils
 from resources.utils import process_images
 from resources.features import extract_features
-from resources import svm
+from resources import svm, worker_pool
+from resources.presets import list_presets, check_preset
 from pages.collage_cutter import CollageCutterWindow
 from pages.results_window import ResultsWindow
 from pages.process_window import ProcessWindow
 from resources.database import initialize_db, update_folder_state, get_all_folders, get_folder_state
-from resources.retry import retry_makedirs
 from components.drop_area import DropArea
 from components.selection_table import SelectionTable
 from time import sleep
@@ -37,6 +40,16 @@ class InspectionThread(QThread):
         self._running = True
 
     def run(self):
+        if self.cutFlag and self.inspectFlag and os.getenv("INSPECTION_CLIENT_FUSED_PIPELINE", "1") == "1":
+            self.progress_update.emit(f'Cutting and inspecting {os.path.basename(self.folder_dir)}, please wait...')
+            svm.cut_and_inspect_folder(self.folder_dir, self.preset_name, self.progress_update, save_halfs=os.getenv("INSPECTION_CLIENT_SAVE_HALFS", "1") == "1")
+            self.state_update.emit({'dir': self.folder_dir, 'state': 'cut'})
+            update_folder_state(self.folder_dir, 'processed')
+            update_folder_state(self.folder_dir, 'inspected')
+            self.state_update.emit({'dir': self.folder_dir, 'state': 'inspected'})
+            self.inspection_done.emit()
+            return
+
         if self.cutFlag:
             self.progress_update.emit(f'Cutting {os.path.basename(self.folder_dir)}, please wait...')
             process_images(self.folder_dir, os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_images', os.path.basename(self.folder_dir)))
@@ -69,6 +82,112 @@ class InspectionThread(QThread):
         self._running = False
         self.wait()
 
+# runs a queue of folders as a pipeline. Once the tasks of the current folder are queued on the shared pool,
+# the cut of the next folder (its fused cut and inspect when that is how it runs) is queued behind them, so
+# the pool goes from one folder to the next without idle workers and without a second core budget.
+class BatchThread(QThread):
+    progress_update = pyqtSignal(str)
+    inspection_done = pyqtSignal()
+    state_update = pyqtSignal(dict)
+
+    def __init__(self, jobs, preset_name):
+        super().__init__()
+        self.jobs = jobs  # [ (folder_dir, cutFlag, inspectFlag), ... ]
+        self.preset_name = preset_name
+        self.fused = os.getenv("INSPECTION_CLIENT_FUSED_PIPELINE", "1") == "1"
+        self.save_halfs = os.getenv("INSPECTION_CLIENT_SAVE_HALFS", "1") == "1"
+
+        self._running = True
+
+    def temp_dir(self, folder_dir):
+        return os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_images', os.path.basename(folder_dir))
+
+    def is_fused(self, cutFlag, inspectFlag):
+        return cutFlag and inspectFlag and self.fused
+
+    # the cutter threads only wait on the shared pool, the work itself runs there; on_submitted lines up the
+    # folder after this one once this one is queued, so fused prefetches keep chaining
+    def prefetch(self, cutter, index, on_submitted):
+        if index >= len(self.jobs) or not self.jobs[index][1]:
+            return None
+        folder_dir, cutFlag, inspectFlag = self.jobs[index]
+        if self.is_fused(cutFlag, inspectFlag):
+            return cutter.submit(svm.cut_and_inspect_folder, folder_dir, self.preset_name, self.progress_update, save_halfs=self.save_halfs, on_submitted=on_submitted)
+        # with an inspection to follow, the next folder waits for it instead
+        return cutter.submit(process_images, folder_dir, self.temp_dir(folder_dir), on_submitted=None if inspectFlag else on_submitted)
+
+    def mark_cut(self, folder_dir):
+        self.progress_update.emit(f'Cut {os.path.basename(folder_dir)}.')
+        self.state_update.emit({'dir': folder_dir, 'state': 'cut'})
+        update_folder_state(folder_dir, 'processed')
+
+    def mark_inspected(self, folder_dir):
+        update_folder_state(folder_dir, 'inspected')
+        self.state_update.emit({'dir': folder_dir, 'state': 'inspected'})
+
+    def run(self):
+        # a prefetched folder still inspecting and the next one cutting behind it
+        with ThreadPoolExecutor(max_workers=2) as cutter:
+            prefetched = {}  # job index: future (None when there was nothing to prefetch)
+            lock = threading.Lock()
+
+            # called once folder index is queued on the pool, from this thread or a cutter thread
+            def start_next(index):
+                with lock:
+                    if index + 1 not in prefetched and self._running:
+                        prefetched[index + 1] = self.prefetch(cutter, index + 1, partial(start_next, index + 1))
+
+            for index, (folder_dir, cutFlag, inspectFlag) in enumerate(self.jobs):
+                if not self._running:
+                    break
+
+                with lock:
+                    current = prefetched.get(index)
+                on_submitted = partial(start_next, index)
+
+                # states are written here, in queue order, never from the cutting threads
+                if current is not None:
+                    self.progress_update.emit(f'Waiting for {os.path.basename(folder_dir)} to be cut...')
+                    current.result()
+                    self.mark_cut(folder_dir)
+                    if self.is_fused(cutFlag, inspectFlag):
+                        self.mark_inspected(folder_dir)
+                        start_next(index)
+                        continue
+                elif self.is_fused(cutFlag, inspectFlag):
+                    self.progress_update.emit(f'Cutting and inspecting {os.path.basename(folder_dir)}, please wait...')
+                    svm.cut_and_inspect_folder(folder_dir, self.preset_name, self.progress_update, save_halfs=self.save_halfs, on_submitted=on_submitted)
+                    self.mark_cut(folder_dir)
+                    self.mark_inspected(folder_dir)
+                    start_next(index)
+                    continue
+                elif cutFlag:
+                    # with an inspection to follow, the next folder waits for its tasks instead
+                    self.progress_update.emit(f'Cutting {os.path.basename(folder_dir)}, please wait...')
+                    process_images(folder_dir, self.temp_dir(folder_dir), on_submitted=None if inspectFlag else on_submitted)
+                    self.mark_cut(folder_dir)
+
+                if inspectFlag:
+                    self.progress_update.emit('Inspection started')
+                    svm.inspect_folder(folder_dir, self.preset_name, self.progress_update, on_submitted=on_submitted)
+                    self.mark_inspected(folder_dir)
+
+                # nothing was queued for this folder, or it failed before queueing
+                start_next(index)
+
+            # stopped: the folders already started finish before the thread does
+            with lock:
+                remaining = [future for future in prefetched.values() if future is not None]
+            for future in remaining:
+                future.result()
+
+        self.inspection_done.emit()
+
+    @pyqtSlot()
+    def stop(self):
+        self._running = False
+        self.wait()
+
 class MainPage(QWidget):
     def __init__(self, stacked_widget):
         super().__init__()
@@ -123,11 +242,8 @@ class MainPage(QWidget):
 
     def load_presets_action(self):
         self.preset_combo.clear()
-        presets_folder = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets')
-        retry_makedirs(presets_folder)
-        for filename in os.listdir(presets_folder):
-            if filename.endswith('.pkl'):
-                self.preset_combo.addItem(filename)
+        for preset_name in list_presets():
+            self.preset_combo.addItem(preset_name)
 
     def open_process_window_action(self):
         self.process_window = ProcessWindow()
@@ -162,10 +278,24 @@ class MainPage(QWidget):
             self.folder_table.setDisabled(False)
             return
 
+        try:
+            check_preset(self.preset_combo.currentText())
+        except Exception as e:
+            self.update_label.setText(f"Cannot use preset: {e}")
+            self.start_inspection_action_btn.setDisabled(False)
+            self.folder_table.setDisabled(False)
+            return
+
         for folder in self.selected_folders:
             self.folder_queue.put(folder)
 
-        self.process_next_folder()
+        # start the shared workers now, they are reused by every queued folder
+        worker_pool.get_pool(self.preset_combo.currentText())
+
+        if os.getenv("INSPECTION_CLIENT_PIPELINE", "1") == "1":
+            self.start_batch()
+        else:
+            self.process_next_folder()
 
     def view_results_action(self):
         options = QFileDialog.Options()
@@ -204,6 +334,21 @@ class MainPage(QWidget):
         else:
             super().keyPressEvent(event)
 
+    def start_batch(self):
+        jobs = []
+        while not self.folder_queue.empty():
+            folder_dir = self.folder_queue.get()
+            table_index = self.folder_table.findItems(folder_dir, Qt.MatchExactly)[0].row()
+            cutFlag = self.folder_table.cellWidget(table_index, 1).isChecked()
+            inspectFlag = self.folder_table.cellWidget(table_index, 2).isChecked()
+            jobs.append((folder_dir, cutFlag, inspectFlag))
+
+        self.worker_thread = BatchThread(jobs, self.preset_combo.currentText())
+        self.worker_thread.progress_update.connect(self.update_label.setText)
+        self.worker_thread.inspection_done.connect(self.process_next_folder)
+        self.worker_thread.state_update.connect(self.update_state)
+        self.worker_thread.start()
+
     def process_next_folder(self):
         if self.worker_thread and self.worker_thread.isRunning():
             self.worker_thread.stop()
@@ -12,6 +12,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from resources import utils
 from resources.features import extract_features
 from resources.svm import PatchLoader, train_svm
+from resources.presets import save_preset_file, PRESET_SUFFIX
 from pages.image_window import ImageWindow
 from sklearn.preprocessing import LabelEncoder
 
@@ -24,7 +25,6 @@ from PyQt5.QtGui import QPixmap, QPainter, QColor, QPen
 from sklearn.svm import SVC
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
-import joblib
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt 
@@ -113,14 +113,14 @@ class NewPresetPage(QWidget):
             print("Preset name cannot be empty")
             return
         
-        svm, scaler, pca, features, labels, patch_names = train_svm(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'patches'))
+        svm, scaler, pca, features, labels, patch_names, metadata = train_svm(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'patches'))
         
         # Save the SVM, scaler, and PCA model
         presets_folder = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets')
         
         retry_makedirs(presets_folder)
 
-        joblib.dump((svm, scaler, pca), os.path.join(presets_folder, f'{preset_name}.pkl'))
+        save_preset_file(os.path.join(presets_folder, f'{preset_name}{PRESET_SUFFIX}'), svm, scaler, pca, metadata)
 
         for i in range(len(features[0]) - 1):
             self.plot_pca(features, labels, scaler, pca, patch_names, i + 1)
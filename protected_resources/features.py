@@ -1,11 +1,18 @@
+import os
 import cv2
 import numpy as np
+from functools import lru_cache
 from skimage import color
-from skimage.feature import graycomatrix, graycoprops
+from resources.feature_kernels import glcm_contrast, glcm_prop
+from resources.feature_timing import timed
 from skimage.filters.rank import entropy
 from skimage.morphology import disk
 
 
+# bump when the features or their order change, cached features of another version are not used
+FEATURE_SET_VERSION = 2
+
+@timed('slope')
 def local_power_spectrum_slope(gray_patch):
     # Step 1: Compute the 2D Fourier Transform of the patch
     dft = cv2.dft(np.float32(gray_patch), flags=cv2.DFT_COMPLEX_OUTPUT)
@@ -43,6 +50,7 @@ def local_power_spectrum_slope(gray_patch):
     
     return slope
 
+@timed('gradient_span')
 def gradient_histogram_span(gray_patch):
     # percentage = 90
     # Step 1: Convert the patch to grayscale
@@ -78,61 +86,415 @@ def gradient_histogram_span(gray_patch):
     
     return span, grad_x, grad_y
 
+@timed('gradient_variance')
+def gradient_variances(grad_x, grad_y, axis=None):
+    return grad_x.var(axis=axis), grad_y.var(axis=axis)
+
+contrast_kernel = timed('glcm_contrast')(glcm_contrast)
+
+# the default feature set for one patch, other sets go through the registry below
 def extract_features(gray_patch):
     slope = local_power_spectrum_slope(gray_patch)
     grad_span, grad_x, grad_y = gradient_histogram_span(gray_patch)
-    
-    # grad_x_var, grad_x_mean = grad_x.var(), grad_x.mean()
-    # grad_y_var, grad_y_mean = grad_y.var(), grad_y.mean()
 
-    grad_x_var = grad_x.var()
-    grad_y_var = grad_y.var()
+    grad_x_var, grad_y_var = gradient_variances(grad_x, grad_y)
 
-    # thresh = cv2.threshold(gray_patch, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # Texture features (contrast, energy, homogeneity), exact without building the glcm
+    contrast = contrast_kernel(gray_patch)
 
-    #entropy_ =  np.var(entropy(gray_patch, disk(5)))
-    
+    features = [slope, grad_span, contrast, grad_x_var, grad_y_var]
 
-    # Texture features (contrast, energy, homogeneity)
-    glcm = graycomatrix(gray_patch, [1], [0], 256, symmetric=True, normed=True)
-    contrast = graycoprops(glcm, 'contrast')[0, 0]
+    return features
+
+def extract_features_from_patches(patches, names=None):
+    if os.getenv("INSPECTION_CLIENT_BATCH_FEATURES", "1") == "1" or (names and names != DEFAULT_FEATURES):
+        return list(zip(patches, extract_features_batch(patches, names=names)))
 
-    # homogeneity = graycoprops(glcm, 'homogeneity')[0, 0]
-    #dissimilarity = graycoprops(glcm, 'dissimilarity')[0, 0]
-    # correlation = graycoprops(glcm, 'correlation')[0, 0]
-    #hist = cv2.calcHist([gray_patch], [0], None, [256], [0, 256])
-    #mode_intensity = np.argmax(hist)
+    patches_features = []
+    for patch in patches:
+        patches_features.append((patch, extract_features(patch)))
     
-    #features = [slope, grad_span, contrast, grad_x_var, grad_x_mean, grad_y_var, grad_y_mean]
-    features = [slope, grad_span, contrast, grad_x_var, grad_y_var]
+    return patches_features
+
+# ------------------------------------------------------------
+# batched engine, same features as extract_features for a stack of patches
+# ------------------------------------------------------------
+
+BATCH_CHUNK = 64
+
+# radius bin of every pixel of the shifted spectrum and the pixels per bin, the same for every patch of a given shape
+@lru_cache(maxsize=8)
+def radial_plan(h, w):
+    X, Y = np.meshgrid(np.arange(w), np.arange(h))
+    X, Y = X - w // 2, Y - h // 2
+    R = np.sqrt(X**2 + Y**2).astype(np.int32).ravel()
+    return R, np.bincount(R)
+
+# the spectrum of every patch comes from cv2.dft like in local_power_spectrum_slope, only the radial
+# plan and the line fit are shared by the stack
+@timed('slope (batch)')
+def power_spectrum_slope_batch(stack):
+    n, h, w = stack.shape
+    R, nr = radial_plan(h, w)
+
+    radialprofile = np.empty((n, len(nr)))
+    for i, patch in enumerate(stack):
+        dft_shift = np.fft.fftshift(cv2.dft(np.float32(patch), flags=cv2.DFT_COMPLEX_OUTPUT))
+        magnitude_spectrum = cv2.magnitude(dft_shift[:,:,0], dft_shift[:,:,1])
+        radialprofile[i] = np.bincount(R, magnitude_spectrum.ravel(), minlength=len(nr)) / (nr + 1e-5)
+    radialprofile = radialprofile[:, 1:]  # Skip the DC component
+
+    # one least squares line per patch when every radius has a positive profile, the radii are then shared
+    complete = np.all(radialprofile > 0, axis=1)
+    slopes = np.empty(n)
+    log_radii = np.log(np.arange(1, radialprofile.shape[1] + 1))
+    centered = log_radii - log_radii.mean()
+    slopes[complete] = (np.log(radialprofile[complete] + 1e-5) @ centered) / (centered @ centered)
+
+    # uniform and saturated patches have empty radii, they go the long way and behave exactly like it
+    for i in np.flatnonzero(~complete):
+        slopes[i] = local_power_spectrum_slope(stack[i])
+
+    return slopes
+
+# cv2.Sobel with ksize=3 of every patch, into one array per direction
+@timed('sobel (batch)')
+def sobel_batch(stack):
+    grad_x = np.empty(stack.shape)
+    grad_y = np.empty(stack.shape)
+    for i, patch in enumerate(stack):
+        grad_x[i] = cv2.Sobel(patch, cv2.CV_64F, 1, 0, ksize=3)
+        grad_y[i] = cv2.Sobel(patch, cv2.CV_64F, 0, 1, ksize=3)
+
+    return grad_x, grad_y
+
+# the gradients of 8 bit patches are integers, so magnitude bin j of np.histogram(range=(0, 256)) holds the
+# squared magnitudes in [j**2, (j + 1)**2), the last bin also 256**2 itself, and larger ones are dropped
+SQUARED_BIN_EDGES = np.arange(256) ** 2
+
+# span between the 5th and 95th percentile bins of the 256 bin magnitude histogram, like gradient_histogram_span
+@timed('gradient_span (batch)')
+def gradient_span_batch(grad_x, grad_y):
+    spans = np.empty(len(grad_x))
+    for i in range(len(grad_x)):
+        squared = np.minimum(grad_x[i] * grad_x[i] + grad_y[i] * grad_y[i], 256**2 + 1).astype(np.int64)
+        hist = np.add.reduceat(np.bincount(squared.ravel(), minlength=256**2 + 2)[:256**2 + 1], SQUARED_BIN_EDGES)
+
+        cumulative_hist = np.cumsum(hist)
+        cumulative_hist_normalized = cumulative_hist / cumulative_hist[-1]
+        spans[i] = np.searchsorted(cumulative_hist_normalized, 0.95) - np.searchsorted(cumulative_hist_normalized, 0.05)
+
+    return spans
+
+# ------------------------------------------------------------
+# feature registry, a preset lists the features it was trained on and only those are computed
+# ------------------------------------------------------------
+
+# what extract_features returns, and what presets saved without a feature list were trained on
+DEFAULT_FEATURES = ['slope', 'grad_span', 'contrast', 'grad_x_var', 'grad_y_var']
+
+# name -> function(context) returning one value per patch of the stack, or an intermediate
+REGISTRY = {}
+REQUIRES = {}
+
+# shared by several features, not features themselves
+INTERMEDIATES = {'sobel', 'grad_vars', 'histogram'}
+
+def register(name, requires=()):
+    def decorator(func):
+        REGISTRY[name] = func
+        REQUIRES[name] = tuple(requires)
+        return func
+    return decorator
+
+# values are computed on first use, so features that share an intermediate compute it once
+class FeatureContext:
+    def __init__(self, stack, known=None):
+        self.stack = stack
+        self.values = dict(known or {})
+
+    def get(self, name):
+        if name not in self.values:
+            for required in REQUIRES[name]:
+                self.get(required)
+            self.values[name] = REGISTRY[name](self)
+        return self.values[name]
+
+    # the context of some of the patches, with what was already computed for them
+    def subset(self, indices):
+        values = {name: tuple(part[indices] for part in value) if isinstance(value, tuple) else value[indices]
+                  for name, value in self.values.items()}
+        return FeatureContext(self.stack[indices], values)
+
+@register('sobel')
+def _sobel(context):
+    return sobel_batch(context.stack)
+
+@register('grad_vars', requires=('sobel',))
+def _grad_vars(context):
+    return gradient_variances(*context.get('sobel'), axis=(1, 2))
+
+@register('histogram')
+def _histogram(context):
+    n = len(context.stack)
+    bins = context.stack.reshape(n, -1).astype(np.int64) + 256 * np.arange(n)[:, None]
+    return np.bincount(bins.ravel(), minlength=256 * n).reshape(n, 256)
+
+@register('slope')
+def _slope(context):
+    return power_spectrum_slope_batch(context.stack)
+
+@register('grad_span', requires=('sobel',))
+def _grad_span(context):
+    return gradient_span_batch(*context.get('sobel'))
+
+@register('grad_x_var', requires=('grad_vars',))
+def _grad_x_var(context):
+    return context.get('grad_vars')[0]
+
+@register('grad_y_var', requires=('grad_vars',))
+def _grad_y_var(context):
+    return context.get('grad_vars')[1]
+
+@register('grad_x_mean', requires=('sobel',))
+def _grad_x_mean(context):
+    return context.get('sobel')[0].mean(axis=(1, 2))
+
+@register('grad_y_mean', requires=('sobel',))
+def _grad_y_mean(context):
+    return context.get('sobel')[1].mean(axis=(1, 2))
+
+@register('contrast')
+def _contrast(context):
+    return contrast_kernel(context.stack)
+
+@register('dissimilarity')
+def _dissimilarity(context):
+    return glcm_prop(context.stack, 'dissimilarity')
+
+@register('homogeneity')
+def _homogeneity(context):
+    return glcm_prop(context.stack, 'homogeneity')
+
+@register('laplacian_var')
+def _laplacian_var(context):
+    return np.array([cv2.Laplacian(patch, cv2.CV_64F).var() for patch in context.stack])
+
+@register('mean_intensity')
+def _mean_intensity(context):
+    return context.stack.mean(axis=(1, 2))
+
+@register('intensity_var')
+def _intensity_var(context):
+    return context.stack.var(axis=(1, 2))
+
+@register('entropy')
+def _entropy(context):
+    return np.array([np.var(entropy(patch, disk(5))) for patch in context.stack])
+
+@register('mode_intensity', requires=('histogram',))
+def _mode_intensity(context):
+    return np.argmax(context.get('histogram'), axis=1)
+
+def check_feature_names(names):
+    unknown = [name for name in names if name not in REGISTRY or name in INTERMEDIATES]
+    if unknown:
+        raise ValueError(f'unknown features: {unknown}')
+    return list(names)
+
+# lets a new preset be trained on another feature set without code edits
+def feature_names_from_env():
+    names = os.getenv("INSPECTION_CLIENT_FEATURES")
+    if not names:
+        return list(DEFAULT_FEATURES)
+    return check_feature_names([name.strip() for name in names.split(',') if name.strip()])
+
+# gradients = (grad_span, grad_x_var, grad_y_var) when they already come from the whole image maps
+def extract_features_stack(stack, gradients=None, names=DEFAULT_FEATURES):
+    known = {}
+    if gradients is not None:
+        known = {'grad_span': gradients[0], 'grad_vars': (gradients[1], gradients[2])}
+    context = FeatureContext(stack, known)
+
+    return np.stack([np.asarray(context.get(name), dtype=np.float64) for name in names], axis=1)
+
+def extract_features_batch(patches, chunk=BATCH_CHUNK, maps=None, coords=None, names=None):
+    names = names or DEFAULT_FEATURES
+    features = [None] * len(patches)
+
+    # patches at the border of an odd sized image can be smaller, they are batched by shape
+    by_shape = {}
+    for i, patch in enumerate(patches):
+        by_shape.setdefault(patch.shape, []).append(i)
+
+    for shape, indices in by_shape.items():
+        if len(shape) != 2 or min(shape) < 3:
+            for i in indices:
+                features[i] = extract_features(patches[i]) if names == DEFAULT_FEATURES else extract_features_stack(patches[i][None], names=names)[0].tolist()
+            continue
+        for start in range(0, len(indices), chunk):
+            chunk_indices = indices[start:start + chunk]
+            stack = np.stack([patches[i] for i in chunk_indices])
+            gradients = None
+            if maps is not None:
+                gradients = gradient_features_from_maps(maps, [coords[i] for i in chunk_indices], [shape] * len(chunk_indices))
+            for i, row in zip(chunk_indices, extract_features_stack(stack, gradients, names).tolist()):
+                features[i] = row
 
     return features
 
-    # LAST
-    #return [slope, grad_span, entropy_, contrast, dissimilarity, correlation, mode_intensity]
-    
-    # OK
-    #return [slope, grad_span, entropy_, contrast, homogeneity, dissimilarity, correlation, mode_intensity]
+# ------------------------------------------------------------
+# whole image gradient maps, the gradient features of every patch come from one Sobel pass over the half
+# ------------------------------------------------------------
 
-    # GOOD
-    # return [slope, grad_span, entropy_, dissimilarity]
-    
-    #return [slope, grad_span, entropy_, contrast, homogeneity, asm, dissimilarity, correlation, mode_intensity]
-    
+@timed('gradient_maps')
+def gradient_maps(image):
+    grad_x = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3)
 
-    # THIS, GREAT
-    #return [slope, grad_span, entropy_, contrast, homogeneity]
+    # sum and sum of squares tables, any rectangle's mean and variance is then 4 lookups
+    sum_x, sqsum_x = cv2.integral2(grad_x, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    sum_y, sqsum_y = cv2.integral2(grad_y, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
 
-   
-    #return [slope, grad_span, laplacian_variance, entropy_, contrast, homogeneity]
-    
-    #return [slope , grad_span, laplacian_variance, mean, std, entropy_, contrast, energy, homogeneity, edge_density]
-    #return [slope , grad_span, cv2.Laplacian(gray_patch, cv2.CV_64F).var(), cv2.countNonZero(thresh)]
-    #return [slope , grad_span]
+    # histogram bin of every pixel's magnitude, 256 stands for values outside of the (0, 256) range
+    magnitude = np.sqrt(grad_x**2 + grad_y**2)
+    bin_map = np.where(magnitude <= 256, np.minimum(magnitude, 255), 256).astype(np.int16)
 
-def extract_features_from_patches(patches):
-    patches_features = []
-    for patch in patches:
-        patches_features.append((patch, extract_features(patch)))
-    
-    return patches_features
\ No newline at end of file
+    return (sum_x, sqsum_x), (sum_y, sqsum_y), bin_map
+
+def rectangle_sums(table, x0, y0, x1, y1):
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+def rectangle_variances(tables, x0, y0, x1, y1):
+    sums, sqsums = tables
+    n = (x1 - x0) * (y1 - y0)
+    mean = rectangle_sums(sums, x0, y0, x1, y1) / n
+    return np.maximum(rectangle_sums(sqsums, x0, y0, x1, y1) / n - mean**2, 0)
+
+@timed('gradient_from_maps')
+def gradient_features_from_maps(maps, coords, patch_shapes):
+    x_tables, y_tables, bin_map = maps
+
+    x0 = np.array([x for x, _ in coords])
+    y0 = np.array([y for _, y in coords])
+    x1 = x0 + np.array([shape[1] for shape in patch_shapes])
+    y1 = y0 + np.array([shape[0] for shape in patch_shapes])
+
+    grad_x_var = rectangle_variances(x_tables, x0, y0, x1, y1)
+    grad_y_var = rectangle_variances(y_tables, x0, y0, x1, y1)
+
+    grad_span = np.empty(len(coords))
+    for i in range(len(coords)):
+        hist = np.bincount(bin_map[y0[i]:y1[i], x0[i]:x1[i]].ravel(), minlength=257)[:256]
+        cumulative_hist = np.cumsum(hist)
+        if cumulative_hist[-1] == 0:
+            grad_span[i] = np.nan
+            continue
+        cumulative_hist_normalized = cumulative_hist / cumulative_hist[-1]
+        grad_span[i] = np.searchsorted(cumulative_hist_normalized, 0.95) - np.searchsorted(cumulative_hist_normalized, 0.05)
+
+    return grad_span, grad_x_var, grad_y_var
+
+# coords are the upper left corners of the patches in the image, as returned by divide_into_patches
+def extract_features_from_image(image, patches, coords, names=None):
+    names = names or DEFAULT_FEATURES
+    if not set(names) & {'grad_span', 'grad_x_var', 'grad_y_var'}:
+        return extract_features_from_patches(patches, names)
+    return list(zip(patches, extract_features_batch(patches, maps=gradient_maps(image), coords=coords, names=names)))
+
+# ------------------------------------------------------------
+# early exit cascade, clearly empty and clearly sharp patches are labeled from two cheap statistics
+# and skip the full features and the svm, the thresholds are learned with the preset
+# ------------------------------------------------------------
+
+def cascade_enabled():
+    return os.getenv("INSPECTION_CLIENT_CASCADE", "1") == "1"
+
+# (intensity variance, grad_x_var + grad_y_var) of the patches of one context
+def context_statistics(context):
+    grad_x_var, grad_y_var = context.get('grad_vars')
+    return context.get('intensity_var'), grad_x_var + grad_y_var
+
+# (intensity variance, grad_x_var + grad_y_var) of every patch, nan for patches too small for the Sobel kernel
+@timed('cascade_statistics')
+def cascade_statistics(patches, chunk=BATCH_CHUNK):
+    intensity_var = np.full(len(patches), np.nan)
+    grad_var = np.full(len(patches), np.nan)
+
+    by_shape = {}
+    for i, patch in enumerate(patches):
+        by_shape.setdefault(patch.shape, []).append(i)
+
+    for shape, indices in by_shape.items():
+        if len(shape) != 2 or min(shape) < 3:
+            continue
+        for start in range(0, len(indices), chunk):
+            chunk_indices = indices[start:start + chunk]
+            context = FeatureContext(np.stack([patches[i] for i in chunk_indices]))
+            intensity_var[chunk_indices], grad_var[chunk_indices] = context_statistics(context)
+
+    return intensity_var, grad_var
+
+# the features of the patches the cascade leaves to the svm (None for the ones it labels), the cascade label
+# of every patch and the cascade statistics of every patch. The statistics and the features come from one
+# context per chunk, so the Sobel pass behind the statistics is not repeated for the features.
+# With maps the gradient values of both come from the whole image maps.
+def extract_features_cascade(patches, cascade=None, names=None, chunk=BATCH_CHUNK, maps=None, coords=None):
+    names = names or DEFAULT_FEATURES
+    features = [None] * len(patches)
+    labels = [None] * len(patches)
+    intensity_var = np.full(len(patches), np.nan)
+    grad_var = np.full(len(patches), np.nan)
+
+    by_shape = {}
+    for i, patch in enumerate(patches):
+        by_shape.setdefault(patch.shape, []).append(i)
+
+    for shape, indices in by_shape.items():
+        if len(shape) != 2 or min(shape) < 3:
+            for i, row in zip(indices, extract_features_batch([patches[i] for i in indices], names=names)):
+                features[i] = row
+            continue
+        for start in range(0, len(indices), chunk):
+            chunk_indices = indices[start:start + chunk]
+            known = {}
+            if maps is not None:
+                grad_span, grad_x_var, grad_y_var = gradient_features_from_maps(maps, [coords[i] for i in chunk_indices], [shape] * len(chunk_indices))
+                known = {'grad_span': grad_span, 'grad_vars': (grad_x_var, grad_y_var)}
+            context = FeatureContext(np.stack([patches[i] for i in chunk_indices]), known)
+
+            statistics = context_statistics(context)
+            intensity_var[chunk_indices], grad_var[chunk_indices] = statistics
+            chunk_labels = cascade_labels(statistics, cascade) if cascade is not None else [None] * len(chunk_indices)
+
+            remaining = [j for j, label in enumerate(chunk_labels) if label is None]
+            if remaining:
+                remaining_context = context.subset(remaining) if len(remaining) < len(chunk_indices) else context
+                rows = np.stack([np.asarray(remaining_context.get(name), dtype=np.float64) for name in names], axis=1)
+                for j, row in zip(remaining, rows.tolist()):
+                    features[chunk_indices[j]] = row
+            for j, label in enumerate(chunk_labels):
+                labels[chunk_indices[j]] = label
+
+    return features, labels, (intensity_var, grad_var)
+
+# 'empty', 'sharp' or None (left to the svm) for every patch, a threshold of None turns its rule off
+def cascade_labels(statistics, cascade):
+    intensity_var, grad_var = statistics
+    labels = np.full(len(grad_var), None, dtype=object)
+
+    with np.errstate(invalid='ignore'):
+        if cascade.get('sharp_grad_var') is not None:
+            labels[grad_var >= cascade['sharp_grad_var']] = 'sharp'
+        if cascade.get('empty_grad_var') is not None and cascade.get('empty_intensity_var') is not None:
+            labels[(grad_var <= cascade['empty_grad_var']) & (intensity_var <= cascade['empty_intensity_var'])] = 'empty'
+
+    return labels.tolist()
+
+# largest relative difference between the batched engine and extract_features over the given patches
+def compare_batch_features(patches):
+    reference = np.array([extract_features(patch) for patch in patches], dtype=np.float64)
+    batched = np.array(extract_features_batch(patches), dtype=np.float64)
+
+    scale = np.maximum(np.abs(reference), 1e-9)
+    return np.max(np.abs(reference - batched) / scale, axis=0)
\ No newline at end of file
@@ -1,8 +1,7 @@
 # imports
 import cv2
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 import threading
-from multiprocessing import cpu_count
 
 import xml.etree.ElementTree as ET
 import time
@@ -20,16 +19,24 @@ import sys
 import os
 import traceback
 
-from resources import utils, cnn
-from resources.features import extract_features, extract_features_from_patches
+from resources import utils, worker_pool
+from resources.features import extract_features, extract_features_from_patches, extract_features_from_image, extract_features_stack, FEATURE_SET_VERSION, DEFAULT_FEATURES, feature_names_from_env
+from resources.features import cascade_enabled, cascade_statistics, cascade_labels, extract_features_cascade, gradient_maps
+from resources import feature_cache, feature_timing, blur_service
 
 import joblib
 import numpy as np
 from multiprocessing import Manager, Queue
 from resources.retry import retry_makedirs, read_image_with_retry, write_image_with_retry
 from resources.log import LoggerSingleton
-
-def inspect_folder(folder_dir, preset_name, progress_update):
+from resources.scoring import compile_scorer
+from resources.presets import check_preset, preset_gating
+from resources.gating import gate
+from resources.manifest import CutManifest
+from resources.coord_map import COORD_MAP_NAME, write_coord_map, append_coords, load_coord_map, coord_scales_dict
+
+# on_submitted is called once every file is queued on the pool
+def inspect_folder(folder_dir, preset_name, progress_update, on_submitted=None):
     temp_dir = os.getenv("INSPECTION_CLIENT_FOLDERS_PATH") + '/temp_images/' + os.path.basename(folder_dir)
     try:
         retry_makedirs(temp_dir)
@@ -40,14 +47,16 @@ def inspect_folder(folder_dir, preset_name, progress_update):
     
     progress_update.emit(f'Inspecting {folder_dir}...)')
     
+    # the preset itself is loaded once per pool worker, only its header is checked here
     try:
-        svm, scaler, pca = joblib.load(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets', preset_name))
+        check_preset(preset_name)
+        gating = preset_gating(preset_name)
     except Exception as e:
         print(f"Error loading SVM model: {e}")
         LoggerSingleton().error(f"Error loading SVM model: {e}")
         return
     
-    collage_handler = CollageHandler(os.path.basename(folder_dir), temp_dir)
+    collage_handler = CollageHandler(os.path.basename(folder_dir), temp_dir, gating=gating)
 
     try:
         n = len(os.listdir(temp_dir))
@@ -57,23 +66,26 @@ def inspect_folder(folder_dir, preset_name, progress_update):
         return
     print('OKAY!!')
     i = 0
+    timings = {}
     with Manager() as manager:
         queue = manager.Queue()
         thread = threading.Thread(target=monitor_queue, args=(queue, collage_handler))
         thread.start()
 
         try:
-            with ProcessPoolExecutor(max_workers=min(int(os.getenv("INSPECTION_CLIENT_MAX_CORES")), cpu_count())) as executor:
-                futures = [executor.submit(process_file, file_name, temp_dir, svm, pca, scaler, queue) for file_name in os.listdir(temp_dir)]
-
-                for future in futures:
-                    try:
-                        future.result()
-                    except Exception as e:
-                        print(f'(Svm-if) Future Exception: {e}')
-                        
-                    i += 1
-                    progress_update.emit(f'{folder_dir} progress: {100 * i / n:.2f}%')
+            executor = worker_pool.get_pool(preset_name)
+            futures = [executor.submit(process_file, file_name, temp_dir, preset_name, queue) for file_name in os.listdir(temp_dir)]
+            if on_submitted is not None:
+                on_submitted()
+
+            for future in futures:
+                try:
+                    feature_timing.merge(timings, future.result())
+                except Exception as e:
+                    print(f'(Svm-if) Future Exception: {e}')
+                    
+                i += 1
+                progress_update.emit(f'{folder_dir} progress: {100 * i / n:.2f}%')
         except Exception as e:
             print(f"Error in process pool execution: {e}")
             LoggerSingleton().error(f"Error in process pool execution: {e}")
@@ -82,16 +94,167 @@ def inspect_folder(folder_dir, preset_name, progress_update):
         thread.join()  # Wait for the thread to finish
 
     collage_handler.finish()
+    feature_cache.get_cache(os.path.basename(temp_dir)).consolidate()
+    feature_timing.write_summary(os.path.basename(folder_dir), timings)
+
+# cuts and inspects a book in one pass, the halfs never go through temp pngs before being classified.
+# With the incremental cut the manifest of the saved halfs is kept like in process_images, tifs whose
+# halfs are still valid are not cut again and their saved halfs are classified instead.
+def cut_and_inspect_folder(folder_dir, preset_name, progress_update, save_halfs=True, incremental=None, on_submitted=None):
+    if incremental is None:
+        incremental = os.getenv("INSPECTION_CLIENT_INCREMENTAL_CUT", "1") == "1"
+    temp_dir = os.getenv("INSPECTION_CLIENT_FOLDERS_PATH") + '/temp_images/' + os.path.basename(folder_dir)
+    try:
+        if incremental:
+            retry_makedirs(temp_dir)
+        else:
+            utils.clear_temp_images(temp_dir)
+    except Exception as e:
+        print(f"Error creating temporary directory: {e}")
+        LoggerSingleton().error(f"Error creating temporary directory: {e}")
+        return
+
+    progress_update.emit(f'Cutting and inspecting {folder_dir}...')
+
+    # the preset itself is loaded once per pool worker, only its header is checked here
+    try:
+        check_preset(preset_name)
+        gating = preset_gating(preset_name)
+    except Exception as e:
+        print(f"Error loading SVM model: {e}")
+        LoggerSingleton().error(f"Error loading SVM model: {e}")
+        return
+
+    collage_handler = CollageHandler(os.path.basename(folder_dir), temp_dir, coord_map={}, gating=gating)
+
+    try:
+        filenames = utils.list_source_images(folder_dir)
+        manifest = CutManifest(temp_dir).load()
+        to_cut = manifest.prepare(filenames, folder_dir)
+    except Exception as e:
+        print(f"Error listing directory contents: {e}")
+        LoggerSingleton().error(f"Error listing directory contents: {e}")
+        return
+
+    kept_halfs = manifest.results()
+    n = len(to_cut) + len(kept_halfs)
+    i = 0
+    timings = {}
+    coord_map_path = os.path.join(temp_dir, COORD_MAP_NAME)
+    write_coord_map(kept_halfs, coord_map_path)
+    for path, coords in kept_halfs:
+        collage_handler.add_page_coords(os.path.basename(path), coords)
+
+    # halfs waiting for the writer, classification waits when the disk falls behind instead of
+    # holding more and more halfs in memory
+    pending_writes = threading.BoundedSemaphore(int(os.getenv("INSPECTION_CLIENT_PENDING_WRITES", "8")))
+    write_futures = {}
+
+    # a tif goes into the manifest once its halfs are on disk
+    def save_halfs_of(filename, pages):
+        try:
+            for path, _, half in pages:
+                write_image_with_retry(path, half)
+            manifest.update(filename, folder_dir, [(path, coords) for path, coords, _ in pages])
+        finally:
+            pending_writes.release()
+
+    # the halfs are written for the results viewer by a background thread while inspection goes on
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        try:
+            executor = worker_pool.get_pool(preset_name)
+            futures = [executor.submit(classify_saved_half, os.path.basename(path), temp_dir, preset_name) for path, _ in kept_halfs]
+            cut_futures = {executor.submit(cut_and_classify_file, filename, folder_dir, temp_dir, preset_name, save_halfs): filename for filename in to_cut}
+            futures.extend(cut_futures)
+            if on_submitted is not None:
+                on_submitted()
+
+            for future in futures:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f'(Svm-caif) Future Exception: {e}')
+                    result = None
+
+                if result is not None:
+                    labeled_patches, pages, worker_timings = result
+                    feature_timing.merge(timings, worker_timings)
+                    append_coords(coord_map_path, [(path, coords) for path, coords, _ in pages])
+                    for path, coords, _ in pages:
+                        collage_handler.add_page_coords(os.path.basename(path), coords)
+                    if save_halfs and pages:
+                        pending_writes.acquire()
+                        write_futures[writer.submit(save_halfs_of, cut_futures[future], pages)] = cut_futures[future]
+
+                    for labeled_patch in labeled_patches:
+                        collage_handler.add_patch(labeled_patch)
+
+                i += 1
+                progress_update.emit(f'{folder_dir} progress: {100 * i / n:.2f}%')
+        except Exception as e:
+            print(f"Error in process pool execution: {e}")
+            LoggerSingleton().error(f"Error in process pool execution: {e}")
+
+        # a tif whose halfs could not be written stays out of the manifest and is cut again next time
+        failed = []
+        for future, filename in write_futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f'(Svm-caif) {filename}: halfs not saved: {e}')
+                LoggerSingleton().error(f'(Svm-caif) {filename}: halfs not saved: {e}')
+                failed.append(filename)
+        if failed:
+            progress_update.emit(f'{folder_dir}: could not save the halfs of {", ".join(sorted(failed))}')
+
+    try:
+        manifest.save()
+    except Exception as e:
+        print(f'(Svm-caif) {e}')
+        LoggerSingleton().error('(Svm-caif) ' + str(e))
+
+    collage_handler.finish()
+    feature_cache.get_cache(os.path.basename(temp_dir)).consolidate()
+    feature_timing.write_summary(os.path.basename(folder_dir), timings)
+
+# a half kept from an earlier cut of the book, in the same shape as cut_and_classify_file
+def classify_saved_half(file_name, temp_dir, preset_name):
+    labeled_patches = process_file(file_name, temp_dir, preset_name, None)
+    if labeled_patches is None:
+        return None
+    return labeled_patches, [], feature_timing.drain()
+
+# returns labeled patches, pages = [ (half path, coords, half or None), ... ] and the feature timings of this task
+def cut_and_classify_file(filename, images_path, temp_dir, preset_name, return_halfs=False):
+    svm, scaler, pca, metadata = worker_pool.get_preset(preset_name)
+    scorer = worker_pool.get_scorer(preset_name)
+    results = []
+    processed = utils.process_and_save_image(filename, images_path, temp_dir, results=results, return_images=True, save_images=False)
+    if processed is None:
+        return None
+
+    halfs, paths, _ = processed
+    labeled_patches = []
+    pages = []
+    for half, (path, coords) in zip(halfs, results):
+        page_patches = read_divide_classify(path, svm, pca, scaler, image=half, cache_name=os.path.basename(temp_dir), metadata=metadata, scorer=scorer)
+        if page_patches is not None:
+            labeled_patches.extend(page_patches)
+        pages.append((path, coords, half if return_halfs else None))
 
-def process_file(file_name, temp_dir, svm, pca, scaler, queue):
+    return labeled_patches, pages, feature_timing.drain()
+
+def process_file(file_name, temp_dir, preset_name, queue):
     if not file_name.endswith('.png'):
         return
     try:
+        svm, scaler, pca, metadata = worker_pool.get_preset(preset_name)
         image_path = os.path.join(temp_dir, file_name)
-        labeled_patches = read_divide_classify(image_path, svm, pca, scaler)
+        labeled_patches = read_divide_classify(image_path, svm, pca, scaler, cache_name=os.path.basename(temp_dir), metadata=metadata, scorer=worker_pool.get_scorer(preset_name))
 
         if queue:
             queue.put(labeled_patches)
+            return feature_timing.drain()
         else:
             return labeled_patches
     except Exception as e:
@@ -111,11 +274,14 @@ def monitor_queue(queue, collage_handler):
             collage_handler.add_patch(labeled_patch)
 
 # labeled_patches = [ (patch, image_count, label, distance, patch coords, image_path), ... ]
-def read_divide_classify(image_path, svm, pca, scaler, image=None):
+# scorer is the one compiled from the preset, built here when the caller has none
+def read_divide_classify(image_path, svm, pca, scaler, image=None, cache_name=None, metadata=None, scorer=None):
     attempts = 0
     while attempts < 10:
         try:
-            patches, coords, gridcoords = utils.divide_into_patches(image if image is not None else read_image_with_retry(image_path, cv2.IMREAD_GRAYSCALE), (int(os.getenv("INSPECTION_CLIENT_GRID_SIZE")), int(os.getenv("INSPECTION_CLIENT_GRID_SIZE"))))
+            if image is None:
+                image = read_image_with_retry(image_path, cv2.IMREAD_GRAYSCALE)
+            patches, coords, gridcoords = utils.divide_into_patches(image, (int(os.getenv("INSPECTION_CLIENT_GRID_SIZE")), int(os.getenv("INSPECTION_CLIENT_GRID_SIZE"))))
             break
         except ZeroDivisionError as e:
             print(f'(Svm-rdf) {e}')
@@ -128,35 +294,151 @@ def read_divide_classify(image_path, svm, pca, scaler, image=None):
             if attempts >= 10: raise Exception(f'rdc: {e}')
             time.sleep(5)
 
-    patch_features = extract_features_from_patches(patches)
+    metadata = metadata or {}
+    patch_features, early_labels = compute_patch_features(image, patches, coords, cache_name, metadata.get('features'), metadata.get('cascade'))
 
     num_of_patches = len(patches)
 
-    transformed_features = pca.transform(scaler.transform([patch_features[i][1] for i in range(num_of_patches)]))
-    labels = svm.predict(transformed_features)
-    decision_scores = svm.decision_function(transformed_features)
+    # patches labeled by the cascade keep their label and the highest possible score
+    labels = np.array(early_labels, dtype=object)
+    scores = np.full(num_of_patches, CASCADE_SCORE)
+    remaining = [i for i in range(num_of_patches) if early_labels[i] is None]
+    if remaining:
+        scorer = scorer or compile_scorer(svm, scaler, pca, metadata)
+        labels[remaining], scores[remaining] = scorer.score([patch_features[i][1] for i in remaining])
     
     basename = os.path.basename(image_path)
 
     image_count = basename[:4]
-    labeled_patches = [[patch_features[i][0], image_count, labels[i], float(max(decision_scores[i])), coords[i], basename, gridcoords[i]] for i in range(num_of_patches)]
+    labeled_patches = [[patch_features[i][0], image_count, labels[i], float(scores[i]), coords[i], basename, gridcoords[i]] for i in range(num_of_patches)]
 
     return labeled_patches
 
-def train_svm(patches_path):
+CASCADE_SCORE = float('inf')
+
+# features of the patches of one half, from the book's feature cache when the same half was seen before
+# returns [ (patch, features or None), ... ] and the cascade label of every patch, None where the svm decides
+def compute_patch_features(image, patches, coords, cache_name=None, feature_names=None, cascade=None):
+    use_maps = os.getenv("INSPECTION_CLIENT_GRADIENT_MAPS", "0") == "1"
+    feature_names = feature_names or DEFAULT_FEATURES
+    if not cascade_enabled():
+        cascade = None
+
+    def extract(indices, cascade):
+        maps = gradient_maps(image) if use_maps else None
+        return extract_features_cascade([patches[i] for i in indices], cascade, feature_names, maps=maps, coords=[coords[i] for i in indices])
+
+    # keyed on the feature set only, so every preset with these features shares the rows. A row holds the
+    # features and the two cascade statistics, the features of patches a cascade labeled are nan until a
+    # preset without that exit needs them.
+    cache = None
+    if cache_name and feature_cache.enabled():
+        cache = feature_cache.get_cache(cache_name)
+        variant = f'{FEATURE_SET_VERSION}-{"maps" if use_maps else "patches"}-{",".join(feature_names)}-statistics'
+        key = cache.key(image, os.getenv("INSPECTION_CLIENT_GRID_SIZE"), variant)
+        cached = cache.get(key)
+        if cached is not None and cached.shape == (len(patches), len(feature_names) + 2):
+            rows, statistics = cached[:, :-2], (cached[:, -2], cached[:, -1])
+            labels = cascade_labels(statistics, cascade) if cascade is not None else [None] * len(patches)
+
+            missing = [i for i in range(len(patches)) if labels[i] is None and np.isnan(rows[i]).any()]
+            if missing:
+                rows[missing] = extract(missing, None)[0]
+                cache.put(key, np.column_stack([rows, statistics[0], statistics[1]]))
+            return [(patch, None if label else row) for patch, label, row in zip(patches, labels, rows.tolist())], labels
+
+    if cache is None and cascade is None:
+        if use_maps:
+            return extract_features_from_image(image, patches, coords, feature_names), [None] * len(patches)
+        return extract_features_from_patches(patches, feature_names), [None] * len(patches)
+
+    features, labels, statistics = extract(range(len(patches)), cascade)
+
+    if cache is not None:
+        skipped = [np.nan] * len(feature_names)
+        cache.put(key, [list(row if row is not None else skipped) + [statistics[0][i], statistics[1][i]] for i, row in enumerate(features)])
+
+    return list(zip(patches, features)), labels
+
+# thresholds on the cascade statistics that let through at most a `quantile` share of the training
+# patches of the other classes, with the report of what they do to the training set accuracy
+def learn_cascade(statistics, labels, predictions, quantile=None):
+    quantile = float(os.getenv("INSPECTION_CLIENT_CASCADE_QUANTILE", "0.005")) if quantile is None else quantile
+    intensity_var, grad_var = statistics
+    known = ~np.isnan(grad_var)
+
+    cascade = {'empty_intensity_var': None, 'empty_grad_var': None, 'sharp_grad_var': None, 'quantile': quantile}
+    not_empty = known & (labels != 'empty')
+    if np.any(labels == 'empty') and np.any(not_empty):
+        cascade['empty_intensity_var'] = float(np.quantile(intensity_var[not_empty], quantile))
+        cascade['empty_grad_var'] = float(np.quantile(grad_var[not_empty], quantile))
+    not_sharp = known & (labels != 'sharp')
+    if np.any(labels == 'sharp') and np.any(not_sharp):
+        cascade['sharp_grad_var'] = float(np.quantile(grad_var[not_sharp], 1 - quantile))
+
+    early = np.array(cascade_labels(statistics, cascade), dtype=object)
+    exits = early != None
+    combined = np.where(exits, early, predictions)
+
+    report = {
+        'patches': int(len(labels)),
+        'early_exits': int(exits.sum()),
+        'early_empty': int((early == 'empty').sum()),
+        'early_sharp': int((early == 'sharp').sum()),
+        'early_exit_accuracy': float((early[exits] == labels[exits]).mean()) if exits.any() else None,
+        'svm_accuracy': float((predictions == labels).mean()),
+        'cascade_accuracy': float((combined == labels).mean()),
+        'changed_predictions': int((combined != predictions).sum()),
+    }
+    cascade['report'] = report
+
+    print(f"cascade: {report['early_exits']}/{report['patches']} patches exit early "
+          f"({report['early_empty']} empty, {report['early_sharp']} sharp), "
+          f"training accuracy {report['svm_accuracy']:.4f} -> {report['cascade_accuracy']:.4f}, "
+          f"{report['changed_predictions']} predictions changed")
+    print(classification_report(labels, combined))
+
+    return cascade
+
+# features of the labeled patches under patches_path, returns (patches, features, labels, patch names) in the same order
+def load_training_features(patches_path, feature_names):
     # load patches
     patch_loader = PatchLoader(patches_path)
     patches, filenames = patch_loader.load_patches_with_filenames()
 
     # get features and labels
+    training_patches = []
     features = []
     labels = []
     patch_names = []
+    cache = feature_cache.get_cache('training') if feature_cache.enabled() else None
     for category, patch_list in patches.items():
         for patch, filename in zip(patch_list, filenames[category]):
-            features.append(extract_features(patch))
+            cached = None
+            if cache is not None:
+                key = cache.key(patch, 1, f'{FEATURE_SET_VERSION}-patch-{",".join(feature_names)}')
+                cached = cache.get(key)
+            if cached is not None:
+                features.append(cached[0].tolist())
+            else:
+                if feature_names == DEFAULT_FEATURES:
+                    features.append(extract_features(patch))
+                else:
+                    features.append(extract_features_stack(patch[None], names=feature_names)[0].tolist())
+                if cache is not None:
+                    cache.put(key, [features[-1]])
+            training_patches.append(patch)
             labels.append(category)
             patch_names.append(filename)
+
+    if cache is not None:
+        cache.consolidate()
+
+    return training_patches, features, labels, patch_names
+
+def train_svm(patches_path, feature_names=None):
+    feature_names = feature_names or feature_names_from_env()
+    training_patches, features, labels, patch_names = load_training_features(patches_path, feature_names)
     
     # convert to numpy arrays
     features = np.array(features)
@@ -206,13 +488,16 @@ def train_svm(patches_path):
 
     print(classification_report(y_test, y_pred))
 
-    return svm, scaler, pca, features, labels, patch_names
+    metadata = {'features': feature_names, 'grid_size': int(os.getenv("INSPECTION_CLIENT_GRID_SIZE")), 'image_size': int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"))}
+    if cascade_enabled():
+        metadata['cascade'] = learn_cascade(cascade_statistics(training_patches), labels, svm.predict(features_reduced))
+
+    return svm, scaler, pca, features, labels, patch_names, metadata
 
 class CollageHandler:
-    def __init__(self, barcode, temp_images_path, live = False):
-        from keras.api.models import load_model
-        
-        self.model = load_model(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"),'blur_detection_model.keras'))
+    def __init__(self, barcode, temp_images_path, live = False, coord_map = None, gating = None):
+        # the blur model lives in the shared inference service, loaded and warmed once per session
+        self.blur_client = blur_service.get_client('collage')
         self.barcode = barcode
         self.blurry_patches = []
         self.blurry_batch_paths = []
@@ -220,19 +505,57 @@ class CollageHandler:
         self.indeterminate_batch_paths = []
         self.empty_patches = []
         self.lock = threading.Lock()  # Add a lock for thread safety
+
+        # blurry and indeterminate patches go to the cnn in batches while the svm stage is still running,
+        # only the ones it confirms are kept (and spilled to temp_files past 10000)
+        self.cnn_batch_size = int(os.getenv("INSPECTION_CLIENT_CNN_BATCH", "256"))
+        self.pending = {'blurry': [], 'indeterminate': []}
+        self.verified = {'blurry': self.blurry_patches, 'indeterminate': self.indeterminate_patches}
+        self.spilled = {'blurry': self.blurry_batch_paths, 'indeterminate': self.indeterminate_batch_paths}
+        self.verified_lock = threading.Lock()
+        self.verifier = ThreadPoolExecutor(max_workers=1)
+        self.verifications = []
+        # batches waiting for the cnn, add_patch blocks past this so a slow cnn does not pile up patches
+        self.inflight = threading.BoundedSemaphore(int(os.getenv("INSPECTION_CLIENT_CNN_INFLIGHT", "8")))
+        # the preset's calibrated score band, patches outside it are kept or dropped without the cnn
+        self.gating = gating
         self.dimensions = int(os.getenv("INSPECTION_CLIENT_GRID_SIZE"))
         self.patch_size =  int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE")) // int(os.getenv("INSPECTION_CLIENT_GRID_SIZE"))
         self.cut_page_coordinates_dict = {}
         self.temp_images_path = temp_images_path
-        self.page_paths_to_coord_scales_dict = self.parse_xml_to_dict()
+        self.image_size = int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"))
         
-        # init cut page coordinates dict from coords_map.xml filein temp_images_path
+        # init cut page coordinates dict from coords_map.xml filein temp_images_path, unless the coords are streamed in
+        if coord_map is None:
+            self.page_paths_to_coord_scales_dict = self.parse_coord_map()
+        else:
+            self.page_paths_to_coord_scales_dict = coord_map
+
+    def coords_to_scales(self, coords):
+        top_left_coords = coords[0]
+        bottom_right_coords = coords[1]
+
+        # Calculate the scale_x and scale_y
+        scale_x = (bottom_right_coords[0] - top_left_coords[0]) / self.image_size
+        scale_y = (bottom_right_coords[1] - top_left_coords[1]) / self.image_size
+
+        return (top_left_coords, scale_x, scale_y)
+
+    def add_page_coords(self, basename, coords):
+        with self.lock:
+            self.page_paths_to_coord_scales_dict[basename] = self.coords_to_scales(coords)
+
+    def parse_coord_map(self):
+        coord_map_path = os.path.join(self.temp_images_path, COORD_MAP_NAME)
+        if not os.path.exists(coord_map_path) and os.path.exists(os.path.join(self.temp_images_path, 'coord_map.xml')):
+            return self.parse_xml_to_dict()
+        return coord_scales_dict(load_coord_map(coord_map_path), self.image_size)
 
+    # books cut before the coord map format was introduced
     def parse_xml_to_dict(self):
         xml_path = os.path.join(self.temp_images_path, 'coord_map.xml')
         tree = ET.parse(xml_path)
         root = tree.getroot()
-        image_size = int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"))
         page_paths_to_coord_scales_dict = {}
 
         for frame in root.findall('frame'):
@@ -241,15 +564,9 @@ class CollageHandler:
 
             # Extract the coordinates from the coords_text
             coords = eval(coords_text)
-            top_left_coords = coords[0]
-            bottom_right_coords = coords[1]
-
-            # Calculate the scale_x and scale_y
-            scale_x = (bottom_right_coords[0] - top_left_coords[0]) / image_size
-            scale_y = (bottom_right_coords[1] - top_left_coords[1]) / image_size
 
             # Add the data to the dictionary
-            page_paths_to_coord_scales_dict[basename] = (top_left_coords, scale_x, scale_y)
+            page_paths_to_coord_scales_dict[basename] = self.coords_to_scales(coords)
 
         return page_paths_to_coord_scales_dict
 
@@ -299,7 +616,7 @@ class CollageHandler:
         new_target = []
 
         patches = [target[i][0] for i in range(len(target))]
-        results = cnn.predict_blur(patches, self.model)
+        results = self.blur_client.predict(patches)
         
         patches.clear()
 
@@ -310,29 +627,72 @@ class CollageHandler:
         target.clear()
         target.extend(new_target)
 
+    # called with self.lock held
+    def submit_verification(self, patch_class):
+        batch = self.pending[patch_class]
+        if not batch:
+            return
+        self.pending[patch_class] = []
+        self.inflight.acquire()
+        self.verifications.append(self.verifier.submit(self.verify_batch, batch, patch_class))
+
+    def verify_batch(self, batch, patch_class):
+        try:
+            svm_batch = list(batch)
+            try:
+                self.filter_non_blurry(batch)
+            except Exception as e:
+                # the batch keeps its svm labels rather than losing the folder
+                print(f'(Collage-vb) {e}')
+                LoggerSingleton().error('(Collage-vb) ' + str(e))
+                batch = svm_batch
+            self.keep_verified(batch, patch_class)
+        finally:
+            self.inflight.release()
+
+    def keep_verified(self, batch, patch_class):
+        with self.verified_lock:
+            target = self.verified[patch_class]
+            target.extend(batch)
+
+            if len(target) >= 10000:
+                cache_list = self.spilled[patch_class]
+                cache_path = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode, f'{patch_class}_{len(cache_list)}.pkl')
+                retry_makedirs(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode))
+                joblib.dump(target, cache_path)
+                cache_list.append(cache_path)
+                target.clear()
+
+    def load_spilled(self, cache):
+        attempts = 0
+        while attempts < 10:
+            try:
+                return joblib.load(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode, cache))
+            except Exception as e:
+                LoggerSingleton().log('joblib ' + str(e))
+                attempts += 1
+                time.sleep(5)
+        return []
+
     def finish(self):
-        for target, patch_class, target_cache in zip([self.blurry_patches, self.empty_patches, self.indeterminate_patches], ['blurry', 'empty', 'indeterminate'], [self.blurry_batch_paths, None, self.indeterminate_batch_paths]):
-            if patch_class == 'empty': continue
-            
-            # save the svm results
-            #self.save_batch_as_image(target, patch_class + f'_svm')
-            cnn_results = []
-            while True:
-                self.filter_non_blurry(target)
-                cnn_results.extend(target)
-
-                if len(target_cache) == 0: break
-
-                attempts = 0
-                cache = target_cache.pop()
-                while attempts < 10:
-                    try:
-                        target = joblib.load(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode, cache)) 
-                        break
-                    except Exception as e:
-                        LoggerSingleton().log('joblib ' + str(e))
-                        attempts += 1
-                        time.sleep(5)
+        # the last partial batches, then wait for the cnn to catch up
+        with self.lock:
+            for patch_class in self.pending:
+                self.submit_verification(patch_class)
+        try:
+            for future in self.verifications:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'(Collage-f) {e}')
+                    LoggerSingleton().error('(Collage-f) ' + str(e))
+        finally:
+            self.verifier.shutdown(wait=True)
+
+        for patch_class in ['blurry', 'indeterminate']:
+            cnn_results = list(self.verified[patch_class])
+            for cache in self.spilled[patch_class]:
+                cnn_results.extend(self.load_spilled(cache))
 
             self.save_batch_as_image(cnn_results, f'{patch_class}_cnn')
             
@@ -341,53 +701,25 @@ class CollageHandler:
         self.save_patches_to_xml(self.cut_page_coordinates_dict)
 
     def add_to_cut_page_coordinates_dict(self, target):
-        for labeled_patch in target:
+        if not target:
+            return
+
+        scales = [self.page_paths_to_coord_scales_dict[labeled_patch[5]] for labeled_patch in target]
+        top_left = np.array([scale[0] for scale in scales], dtype=np.float64)
+        scale_xy = np.array([(scale[1], scale[2]) for scale in scales], dtype=np.float64)
+        patch_coords = np.array([labeled_patch[4] for labeled_patch in target], dtype=np.float64)
+
+        page_coords = (top_left + patch_coords * scale_xy).astype(int).tolist()
+        page_sizes = (200 * scale_xy).astype(int).tolist()
+
+        for labeled_patch, (x, y), (w, h) in zip(target, page_coords, page_sizes):
             num_of_page = labeled_patch[1]
-            path = labeled_patch[5]
 
             # add patch to coord dict
             if not num_of_page in self.cut_page_coordinates_dict.keys():
                 self.cut_page_coordinates_dict[num_of_page] = []
 
-            xp = labeled_patch[4][0]
-            yp = labeled_patch[4][1]
-            xa = self.page_paths_to_coord_scales_dict[path][0][0]
-            ya = self.page_paths_to_coord_scales_dict[path][0][1]
-
-            scale_x = self.page_paths_to_coord_scales_dict[path][1]
-            scale_y = self.page_paths_to_coord_scales_dict[path][2]
-
-            self.cut_page_coordinates_dict[num_of_page].append((int(xa + xp * scale_x), int(ya + yp * scale_y) , int(200 * scale_x), int(200 * scale_y)))
-
-    def finish_old(self):
-        for target, patch_class, target_cache in zip([self.blurry_patches, self.empty_patches, self.indeterminate_patches], ['blurry', 'empty', 'indeterminate'], [self.blurry_batch_paths, None, self.indeterminate_batch_paths]):
-            if patch_class == 'empty': continue
-            
-            self.save_batch_as_image(target, patch_class + f'_svm')
-            self.filter_non_blurry(target)
-            self.save_batch_as_image(target, patch_class + f'_cnn')
-            
-            # create dict
-            for labeled_patch in target:
-                num_of_page = labeled_patch[1]
-                path = labeled_patch[5]
-
-                # add patch to coord dict
-                if not num_of_page in self.cut_page_coordinates_dict.keys():
-                    self.cut_page_coordinates_dict[num_of_page] = []
-
-                xp = labeled_patch[4][0]
-                yp = labeled_patch[4][1]
-                xa = self.page_paths_to_coord_scales_dict[path][0][0]
-                ya = self.page_paths_to_coord_scales_dict[path][0][1]
-
-                scale_x = self.page_paths_to_coord_scales_dict[path][1]
-                scale_y = self.page_paths_to_coord_scales_dict[path][2]
-
-                self.cut_page_coordinates_dict[num_of_page].append(( int(xa + xp * scale_x), int(ya + yp * scale_y) , int(200 * scale_x), int(200 * scale_y)))
-            target.clear()
-        
-        self.save_patches_to_xml(self.cut_page_coordinates_dict)
+            self.cut_page_coordinates_dict[num_of_page].append((x, y, w, h))
 
     def save_patches_to_xml(self, patches_dict : dict):
         folder_path = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'collages')
@@ -412,31 +744,26 @@ class CollageHandler:
 
     def add_patch(self, labeled_patch):
         with self.lock:  # Ensure thread-safe access
-            target = None
             patch_class = labeled_patch[2]
 
-            if patch_class == 'blurry':
-                target = self.blurry_patches
-            elif patch_class == 'empty':
-                target = self.empty_patches
-            elif patch_class == 'indeterminate':
-                target = self.indeterminate_patches
-
-            if target is None:
-                return 0  # Didn't add anything
-            
             if patch_class == 'empty':
                 return 1  # added empty
 
+            if patch_class not in self.pending:
+                return 0  # Didn't add anything
+
+            decision = gate(patch_class, labeled_patch[3], self.gating)
+            if decision == 'reject':
+                return 0
+            if decision == 'accept':
+                self.keep_verified([labeled_patch], patch_class)
+                return 2
+
+            target = self.pending[patch_class]
             target.append(labeled_patch)
 
-            if len(target) >= 10000:
-                cache_list = self.blurry_batch_paths if patch_class == 'blurry' else self.indeterminate_batch_paths
-                cache_path = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode, f'{patch_class}_{len(cache_list)}.pkl')
-                retry_makedirs(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'temp_files', self.barcode))
-                joblib.dump(target, cache_path)
-                cache_list.append(cache_path)
-                target.clear()
+            if len(target) >= self.cnn_batch_size:
+                self.submit_verification(patch_class)
             
             return 2  # added blurry
        
@@ -1,11 +1,13 @@
 import cv2
 import os
 import numpy as np
-from multiprocessing import cpu_count, Manager
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from resources.retry import *
-from resources.log import LoggerSingleton, debug
-import xml.etree.ElementTree as ET
+from resources.log import LoggerSingleton
+from resources.manifest import CutManifest
+from resources import worker_pool
+from resources.tiff_reader import read_tiff_with_retry, read_tiff_reduced
+from resources.coord_map import COORD_MAP_NAME, write_coord_map, append_coords
 
 test = True
 
@@ -13,14 +15,15 @@ SMOOTH_CONSTANT = 95
 THRESHOLD_FOR_GLOSS = 250
 
 # function that splits the image, returns the lafs
-def process_image(img):
+def process_image(img, coarse=None):
     halfs = split_image(img)
+    coarse_halfs = split_image(coarse) if coarse is not None else (None, None)
 
     processed_halfs = []
     coords = []
 
-    for i, half in zip(range(2), halfs):
-        processed_half, upper_left_coords, lower_right_coords = remove_surrounding_non_pages(half)
+    for i, half, coarse_half in zip(range(2), halfs, coarse_halfs):
+        processed_half, upper_left_coords, lower_right_coords = remove_surrounding_non_pages(half, coarse=coarse_half)
         processed_halfs.append(processed_half)
         
         if i == 1:
@@ -43,7 +46,7 @@ def read_images(images_path, temp_images_path):
             os.remove(temp_images_path + '/' + filename)
 
     for filename in os.listdir(images_path):
-        image = read_image_with_retry(os.path.join(images_path, filename), cv2.IMREAD_GRAYSCALE)
+        image = read_tiff_with_retry(os.path.join(images_path, filename))
         halfs, coords = process_image(image)
         
         labels = ['left', 'right']
@@ -53,22 +56,19 @@ def read_images(images_path, temp_images_path):
 
     return images
 
-def process_and_save_image(filename, images_path, temp_images_path, counter=None, total_files=None, lock=None, results=None, return_images = False):
-    print('is this thing even called?')
+def process_and_save_image(filename, images_path, temp_images_path, counter=None, total_files=None, lock=None, results=None, return_images = False, save_images = True):
     retry_makedirs(temp_images_path)
-    print(' i guess so')
     if not filename.endswith('.tif') or 'thumb' in filename:
         return
-    print('bitchass..')
     image_path = os.path.join(images_path, filename)
-    print(image_path)
     temp_image_path = os.path.join(temp_images_path, f"{filename.split('.')[0]}_{{}}.png")
-    print('ok?')
     attempts = 0
     while attempts < 10:
         try: 
-            image = read_image_with_retry(image_path, cv2.IMREAD_GRAYSCALE)
-            halfs, coords_pair = process_image(image)
+            image = read_tiff_with_retry(image_path)
+            levels = boundary_pyramid_levels()
+            coarse = read_tiff_reduced(image_path, 2 ** levels, allow_decode=False) if levels > 0 else None
+            halfs, coords_pair = process_image(image, coarse)
             break
         except Exception as e:
             print(f'(Utils-pasi1) {e}')
@@ -76,7 +76,6 @@ def process_and_save_image(filename, images_path, temp_images_path, counter=None
             time.sleep(0.1)
             attempts += 1
             if attempts >= 10: return
-    print('ok??')
     labels = ['left', 'right']
     
     attempts = 0
@@ -89,7 +88,8 @@ def process_and_save_image(filename, images_path, temp_images_path, counter=None
                 new_img_path = temp_image_path.format(label)
                 if not new_img_path in paths:
                     paths.append(new_img_path)
-                write_image_with_retry(temp_image_path.format(label), half)
+                if save_images:
+                    write_image_with_retry(temp_image_path.format(label), half)
                 
                 if results is not None:
                     results.append((new_img_path, coords))
@@ -100,7 +100,6 @@ def process_and_save_image(filename, images_path, temp_images_path, counter=None
                 time.sleep(5)
                 attempts += 1
                 if attempts >= 10: return
-    print('ok???')
     if lock is not None:
         with lock:
             counter.value += 1
@@ -113,80 +112,77 @@ def process_and_save_image(filename, images_path, temp_images_path, counter=None
         return halfs, paths, filename[:4]
     return paths
 
-def process_images(images_path, temp_images_path):
+def clear_temp_images(temp_images_path):
+    attempts = 0
+    while attempts < 10:
+        try:
+            print(temp_images_path)
+            retry_makedirs(temp_images_path)
+        
+            for filename in os.listdir(temp_images_path):
+                os.remove(os.path.join(temp_images_path, filename))
+            break
+        except Exception as e:
+            LoggerSingleton().error('(Utils-pi)' + e.__str__())
+            attempts += 1
+            if attempts >= 10:
+                raise Exception('could not initiate image cutting')
+
+def list_source_images(images_path):
+    return [f for f in os.listdir(images_path) if f.endswith('.tif') and 'thumb' not in f]
+
+# worker side of process_images, the results travel back with the future instead of through a manager
+def cut_image(filename, images_path, temp_images_path):
+    results = []
+    paths = process_and_save_image(filename, images_path, temp_images_path, results=results)
+    return paths, results
+
+# on_submitted is called once every cut is queued on the pool
+def process_images(images_path, temp_images_path, incremental=os.getenv("INSPECTION_CLIENT_INCREMENTAL_CUT", "1") == "1", executor=None, on_submitted=None):
     
     try:
-        attempts = 0
-        while attempts < 10:
+        if incremental:
+            retry_makedirs(temp_images_path)
+        else:
+            clear_temp_images(temp_images_path)
+
+        # only new or changed tifs are cut again, the rest is kept from the previous run
+        manifest = CutManifest(temp_images_path).load()
+        filenames = manifest.prepare(list_source_images(images_path), images_path)
+        total_files = len(filenames)
+        coord_map_path = os.path.join(temp_images_path, COORD_MAP_NAME)
+        write_coord_map(manifest.results(), coord_map_path)
+        LoggerSingleton().log(f'(Utils-pi) {os.path.basename(images_path)} processing progress: 0%')
+        if executor is None:
+            executor = worker_pool.get_pool()
+        futures = {
+            executor.submit(cut_image, filename, images_path, temp_images_path): filename
+            for filename in filenames
+        }
+        if on_submitted is not None:
+            on_submitted()
+        milestones = [int(total_files * i) for i in [0.01, 0.25, 0.5, 0.75, 1]]
+        done = 0
+        for future in as_completed(futures):
+            done += 1
+            if done in milestones:
+                print(f'{os.path.basename(images_path)} processing progress: {done / total_files:.2f}%')
             try:
-                print(temp_images_path)
-                retry_makedirs(temp_images_path)
-            
-                for filename in os.listdir(temp_images_path):
-                    os.remove(os.path.join(temp_images_path, filename))
-                break
+                paths, results = future.result()
             except Exception as e:
-                LoggerSingleton().error('(Utils-pi)' + e.__str__())
-                attempts += 1
-                if attempts >= 10:
-                    raise Exception('could not initiate image cutting')
-
-        for i in range(5):
-            debug(f'ok1 {i}')
-            time.sleep(1)
-
-        manager = Manager()
-        debug('ok2')
-        counter = manager.Value('i', 0)
-        debug('ok3')
-        lock = manager.Lock()
-        debug('ok4')
-        results = manager.list()
-        debug('ok5')
-        total_files = len([f for f in os.listdir(images_path) if f.endswith('.tif') and 'thumb' not in f])
-        debug('ok6')
-        filenames = [f for f in os.listdir(images_path) if f.endswith('.tif') and 'thumb' not in f]
-        debug('ok7')
-        output_xml_path = os.path.join(temp_images_path, 'coord_map.xml')
-        debug('ok8')
-        LoggerSingleton().log(f'(Utils-pi) {os.path.basename(images_path)} processing progress: 0%')
-        debug('ok9')
-        with ProcessPoolExecutor(max_workers=min(int(os.getenv("INSPECTION_CLIENT_MAX_CORES")), cpu_count())) as executor:
-            futures = [
-                executor.submit(
-                    process_and_save_image,
-                    filename,
-                    images_path,
-                    temp_images_path,
-                    counter,
-                    total_files,
-                    lock,
-                    results
-                )
-                for filename in filenames
-            ]
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f'(Utils-pi) Future exception: {e}')
-        write_results_to_xml(results, output_xml_path)
+                print(f'(Utils-pi) Future exception: {e}')
+                continue
+            if not paths:
+                continue
+
+            coords_by_path = dict(results)
+            page_results = [(path, coords_by_path[path]) for path in paths if path in coords_by_path]
+            append_coords(coord_map_path, page_results)
+            manifest.update(futures[future], images_path, page_results)
+        manifest.save()
     except Exception as e:
         print(f'(Utils-pii) {e}')
 
-def write_results_to_xml(results, output_path):
-    root = ET.Element("frames")
-
-    for new_img_path, coords in results:
-        frame = ET.SubElement(root, "frame")
-        basename = ET.SubElement(frame, "basename")
-        basename.text = os.path.basename(new_img_path)
-        coords_element = ET.SubElement(frame, "coords")
-        coords_element.text = str(coords)
-
-    tree = ET.ElementTree(root)
-    tree.write(output_path, encoding="UTF-8", xml_declaration=True)
-
 # coords: [(x, y), ..]
 def divide_into_patches(img, dimensions):
     if img is None:
@@ -214,26 +210,30 @@ def divide_into_patches(img, dimensions):
         row_index += 1
     return patches, coords, gridcoords
 
-def remove_surrounding_non_pages(image, square_size=int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"))):
-    gray = image
+# finds the bounding box of the page in the image, returns (x, y, w, h)
+def find_page_bounds(image):
+    return find_page_bounds_and_threshold(image)[:4]
 
+# also the Otsu threshold the page was separated with, None when no contour was kept
+def find_page_bounds_and_threshold(image):
     # Apply GaussianBlur to reduce noise and improve contour detection
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    blurred = cv2.GaussianBlur(image, (5, 5), 0)
     
     rows, cols = image.shape[:2]
     total_area = rows * cols
 
     last_w, last_h = 100000, 100000
     upper_left_x, upper_left_y = 0, 0
-    lower_right_x, lower_right_y = cols, rows
+    new_cols, new_rows = cols, rows
+    page_threshold = None
 
     for i in range(5):
         # Find contours in the binary image
-        _, thresholded = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        threshold, thresholded = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
         contours, _ = cv2.findContours(thresholded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
-        # If no contours were found, return the original image
+        # If no contours were found, keep the current bounds
         if not contours:
             break
 
@@ -250,14 +250,132 @@ def remove_surrounding_non_pages(image, square_size=int(os.getenv("INSPECTION_CL
         # Update the coordinates
         upper_left_x += x
         upper_left_y += y
+        new_cols, new_rows = w, h
+        page_threshold = threshold
         
-        # Crop the image to the bounding box
-        image = image[y:y+h, x:x+w]
-
-        # Recalculate the gray, blurred, and thresholded images for the cropped image
-        #gray = gray[y:y+h, x:x+w]
+        # Crop the blurred image to the bounding box
         blurred = blurred[y:y+h, x:x+w]
-    
+
+    return upper_left_x, upper_left_y, new_cols, new_rows, page_threshold
+
+# number of pyramid levels for the given tolerance (in full resolution pixels), a coarse pixel is at most a
+# quarter of it so the coarse edges rarely move by more than the tolerance and need the full resolution pass
+def boundary_pyramid_levels(tolerance=int(os.getenv("INSPECTION_CLIENT_BOUNDARY_TOLERANCE", "0"))):
+    levels = 0
+    while levels < 4 and 2 ** (levels + 2) <= tolerance:
+        levels += 1
+    return levels
+
+# strip of full resolution pixels searched on each side of a coarse edge, wide enough for any edge the
+# tolerance accepts plus the rounding of the coarse pixels
+def refine_margin(levels, tolerance):
+    return tolerance + 2 ** (levels + 1)
+
+# the blurred and thresholded full resolution pixels of image[y0:y1, x0:x1], blurred with the context
+# find_page_bounds would have had so the strip matches the full image pass
+def threshold_strip(image, x0, y0, x1, y1, threshold):
+    rows, cols = image.shape[:2]
+    px0, py0, px1, py1 = max(x0 - 2, 0), max(y0 - 2, 0), min(x1 + 2, cols), min(y1 + 2, rows)
+    blurred = cv2.GaussianBlur(image[py0:py1, px0:px1], (5, 5), 0)
+    return blurred[y0 - py0:y1 - py0, x0 - px0:x1 - px0] > threshold
+
+# extent along axis (0 rows, 1 columns) of the page pixels of the strip, the components touching its
+# inner side, or None when the strip has none
+def page_extent(mask, axis, inner_end):
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    if axis == 1:
+        inner = labels[:, -1] if inner_end else labels[:, 0]
+    else:
+        inner = labels[-1] if inner_end else labels[0]
+    page = np.setdiff1d(np.unique(inner), [0])
+    if len(page) == 0:
+        return None
+    start, size = (cv2.CC_STAT_LEFT, cv2.CC_STAT_WIDTH) if axis == 1 else (cv2.CC_STAT_TOP, cv2.CC_STAT_HEIGHT)
+    return int(stats[page, start].min()), int((stats[page, start] + stats[page, size]).max())
+
+# moves every edge of the coarse box to the full resolution page pixels within margin of it, None when an
+# edge is not inside its strip and the coarse box cannot be trusted
+def refine_page_bounds(image, bounds, threshold, margin):
+    rows, cols = image.shape[:2]
+    x0, y0, x1, y1 = bounds
+
+    # the left and right strips span the coarse height plus the margin, and so on
+    span_y0, span_y1 = max(y0 - margin, 0), min(y1 + margin, rows)
+    span_x0, span_x1 = max(x0 - margin, 0), min(x1 + margin, cols)
+
+    left = (max(x0 - margin, 0), min(x0 + margin, cols))
+    right = (max(x1 - margin, 0), min(x1 + margin, cols))
+    top = (max(y0 - margin, 0), min(y0 + margin, rows))
+    bottom = (max(y1 - margin, 0), min(y1 + margin, rows))
+
+    extents = [
+        page_extent(threshold_strip(image, left[0], span_y0, left[1], span_y1, threshold), 1, True),
+        page_extent(threshold_strip(image, right[0], span_y0, right[1], span_y1, threshold), 1, False),
+        page_extent(threshold_strip(image, span_x0, top[0], span_x1, top[1], threshold), 0, True),
+        page_extent(threshold_strip(image, span_x0, bottom[0], span_x1, bottom[1], threshold), 0, False),
+    ]
+    if None in extents:
+        return None
+
+    new_x0 = left[0] + extents[0][0]
+    new_x1 = right[0] + extents[1][1]
+    new_y0 = top[0] + extents[2][0]
+    new_y1 = bottom[0] + extents[3][1]
+
+    # an edge on the outer side of its strip may lie further out, unless that side is the image border
+    if (new_x0 == left[0] > 0 or new_x1 == right[1] < cols or new_y0 == top[0] > 0 or new_y1 == bottom[1] < rows
+            or new_x1 <= new_x0 or new_y1 <= new_y0):
+        return None
+    return new_x0, new_y0, new_x1, new_y1
+
+# finds the page bounds on a downscaled copy, maps them back to full resolution and refines every edge on
+# the full resolution pixels around it, falls back to find_page_bounds when an edge moves by more than the
+# tolerance or cannot be refined
+def find_page_bounds_coarse(image, levels, coarse=None, tolerance=None):
+    rows, cols = image.shape[:2]
+    if tolerance is None:
+        tolerance = int(os.getenv("INSPECTION_CLIENT_BOUNDARY_TOLERANCE", "0"))
+
+    if coarse is None:
+        coarse = image
+        for i in range(levels):
+            coarse = cv2.pyrDown(coarse)
+
+    coarse_rows, coarse_cols = coarse.shape[:2]
+    scale_x = cols / coarse_cols
+    scale_y = rows / coarse_rows
+
+    x, y, w, h, threshold = find_page_bounds_and_threshold(coarse)
+    if threshold is None:
+        return find_page_bounds(image)
+
+    x0 = min(int(round(x * scale_x)), cols - 1)
+    y0 = min(int(round(y * scale_y)), rows - 1)
+    x1 = max(min(int(round((x + w) * scale_x)), cols), x0 + 1)
+    y1 = max(min(int(round((y + h) * scale_y)), rows), y0 + 1)
+
+    refined = refine_page_bounds(image, (x0, y0, x1, y1), threshold, refine_margin(levels, tolerance))
+    if refined is None or max(abs(a - b) for a, b in zip(refined, (x0, y0, x1, y1))) > tolerance:
+        return find_page_bounds(image)
+
+    x0, y0, x1, y1 = refined
+    return x0, y0, x1 - x0, y1 - y0
+
+def remove_surrounding_non_pages(image, square_size=int(os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE")), levels=None, coarse=None):
+    if levels is None:
+        levels = boundary_pyramid_levels()
+
+    # only the crop and the resize touch the full resolution image in coarse mode
+    if levels > 0 or coarse is not None:
+        x, y, w, h = find_page_bounds_coarse(image, levels, coarse)
+    else:
+        x, y, w, h = find_page_bounds(image)
+
+    upper_left_x, upper_left_y = x, y
+
+    # Crop the image to the bounding box
+    image = image[y:y+h, x:x+w]
+
     new_rows, new_cols = image.shape[:2]
     # Update the lower right coordinates based on the resizing
     lower_right_x = upper_left_x + new_cols
@@ -268,6 +386,14 @@ def remove_surrounding_non_pages(image, square_size=int(os.getenv("INSPECTION_CL
 
     return image, [upper_left_x, upper_left_y], [int(lower_right_x), int(lower_right_y)]
 
+# checks that the coarse bounds match the full resolution ones within tolerance pixels
+def compare_page_bounds(image, tolerance=int(os.getenv("INSPECTION_CLIENT_BOUNDARY_TOLERANCE", "0"))):
+    x, y, w, h = find_page_bounds(image)
+    cx, cy, cw, ch = find_page_bounds_coarse(image, boundary_pyramid_levels(tolerance), tolerance=tolerance)
+
+    error = max(abs(x - cx), abs(y - cy), abs((x + w) - (cx + cw)), abs((y + h) - (cy + ch)))
+    return error <= tolerance, error
+
 def save_images(images, base_path, frame_name):
     print(f"Saving images for {frame_name}")
     for field_name, image in images.items():
@@ -0,0 +1,213 @@
+import os
+import time
+import uuid
+import threading
+import numpy as np
+from multiprocessing import Process, Queue, Pipe
+from resources.log import LoggerSingleton
+
+# One process per application session owns the blur cnn: it loads and warms the model once and answers
+# predict requests from every caller. Each process that calls it reads its own channel (response queue):
+# 'collage' in the application, 'live' in the live classify worker. Requests carry an id that the reply
+# echoes, and one router per channel in that process hands every reply to the request it answers, so any
+# number of callers (the collage handlers of overlapping folders) can share the channel. A reply whose caller
+# gave up (timeout) is dropped.
+CHANNELS = ('collage', 'live')
+
+# seconds between two checks that the service is still running while a caller waits for its reply
+LIVENESS_INTERVAL = 1.0
+
+# the backend chosen by INSPECTION_CLIENT_BLUR_BACKEND, see cnn.load_blur_backend
+def load_blur_model():
+    from resources.cnn import predict_blur, load_blur_backend
+
+    model = load_blur_backend()
+    # the first predict builds and traces the graph, pay for it before the first real request
+    predict_blur([np.zeros((200, 200), dtype=np.uint8)], model)
+    return model
+
+# alive is the write end of a pipe nobody writes to, held for as long as this process runs: when the process
+# dies it closes and the callers see it (see BlurClient.service_alive)
+def serve(requests, responses, alive=None):
+    from resources.cnn import predict_blur
+
+    error = None
+    try:
+        model = load_blur_model()
+    except Exception as e:
+        print(f'(Blur-s) {e}')
+        LoggerSingleton().error('(Blur-s) ' + str(e))
+        model = None
+        error = str(e)
+
+    while True:
+        request = requests.get()
+        if request is None:  # Stop signal
+            break
+        channel, request_id, patches = request
+        try:
+            if model is None:
+                raise RuntimeError(f'blur model could not be loaded: {error}')
+            responses[channel].put((request_id, 'ok', [bool(result) for result in predict_blur(patches, model)]))
+        except Exception as e:
+            responses[channel].put((request_id, 'error', str(e)))
+
+# reads one channel in this process and hands each reply to the request waiting for it
+class ReplyRouter:
+    def __init__(self, responses, channel):
+        self.responses = responses
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.waiting = {}  # request id: [event, reply]
+        self.thread = threading.Thread(target=self.route, daemon=True)
+        self.thread.start()
+
+    def route(self):
+        while True:
+            try:
+                reply_id, status, result = self.responses.get()
+            except (EOFError, OSError):  # the queue is closed, the process is exiting
+                return
+            with self.lock:
+                waiter = self.waiting.pop(reply_id, None)
+            if waiter is None:
+                # the late answer to a request whose caller gave up
+                LoggerSingleton().error(f'(Blur-r) dropped a stale reply on channel {self.channel}')
+                continue
+            waiter[1] = (status, result)
+            waiter[0].set()
+
+    def expect(self, request_id):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.waiting[request_id] = waiter
+        return waiter
+
+    def forget(self, request_id):
+        with self.lock:
+            self.waiting.pop(request_id, None)
+
+# by (process id, channel), a forked process does not inherit the parent's router thread
+_routers = {}
+_routers_lock = threading.Lock()
+
+def reply_router(responses, channel):
+    key = (os.getpid(), channel)
+    with _routers_lock:
+        if key not in _routers:
+            _routers[key] = ReplyRouter(responses, channel)
+        return _routers[key]
+
+# what callers hold, can be passed to processes created by the main process
+class BlurClient:
+    def __init__(self, requests, responses, channel, alive=None):
+        self.requests = requests
+        self.responses = responses
+        self.channel = channel
+        self.alive = alive
+
+    # works in any process, unlike Process.is_alive(): the read end of the service's pipe polls as ready
+    # (end of file) or fails once the service process is gone
+    def service_alive(self):
+        if self.alive is None:
+            return True
+        try:
+            return not self.alive.poll()
+        except (EOFError, OSError):
+            return False
+
+    # raises when the service does not answer or has died, the callers keep their svm labels then
+    def predict(self, patches):
+        if len(patches) == 0:
+            return []
+        if not self.service_alive():
+            LoggerSingleton().error('(Blur-c) blur service is not running')
+            raise RuntimeError('blur service is not running')
+
+        router = reply_router(self.responses, self.channel)
+        request_id = uuid.uuid4().hex
+        waiter = router.expect(request_id)
+        self.requests.put((self.channel, request_id, list(patches)))
+        deadline = time.monotonic() + float(os.getenv("INSPECTION_CLIENT_BLUR_TIMEOUT", "600"))
+        while not waiter[0].wait(timeout=min(LIVENESS_INTERVAL, max(deadline - time.monotonic(), 0))):
+            if not self.service_alive():
+                router.forget(request_id)
+                LoggerSingleton().error('(Blur-c) blur service stopped while waiting for a reply')
+                raise RuntimeError('blur service stopped')
+            if time.monotonic() >= deadline:
+                router.forget(request_id)
+                raise RuntimeError('blur service did not answer')
+        status, result = waiter[1]
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+# the model in the caller's own process, when the service is turned off
+class LocalBlurClient:
+    def __init__(self):
+        self.model = None
+        self.lock = threading.Lock()
+
+    # passed to another process without the model, it loads its own
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def predict(self, patches):
+        from resources.cnn import predict_blur
+
+        if len(patches) == 0:
+            return []
+        with self.lock:
+            if self.model is None:
+                self.model = load_blur_model()
+            return predict_blur(patches, self.model)
+
+class BlurService:
+    def __init__(self):
+        self.requests = Queue()
+        self.responses = {channel: Queue() for channel in CHANNELS}
+        self.alive, alive_end = Pipe(duplex=False)
+        self.alive_end = alive_end
+        self.process = Process(target=serve, args=(self.requests, self.responses, alive_end), daemon=True)
+
+    def start(self):
+        self.process.start()
+        # only the service keeps the write end open
+        self.alive_end.close()
+
+    def client(self, channel):
+        return BlurClient(self.requests, self.responses[channel], channel, self.alive)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+
+_service = None
+
+def enabled():
+    return os.getenv("INSPECTION_CLIENT_BLUR_SERVICE", "1") == "1"
+
+# started by main at application start so the model is warm before the first inspection
+def start_service():
+    global _service
+    if _service is None and enabled():
+        _service = BlurService()
+        _service.start()
+    return _service
+
+def get_client(channel):
+    if not enabled():
+        return LocalBlurClient()
+    return start_service().client(channel)
+
+def stop_service():
+    global _service
+    if _service is not None:
+        _service.stop()
+        _service = None
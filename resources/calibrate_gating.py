@@ -0,0 +1,85 @@
+# Picks the cnn gating band of a preset from the labeled patches and stores it in the preset.
+#
+#   python -m resources.calibrate_gating LATEST-JUL25_19_16-RBF.preset --target-recall 0.98
+#
+# Every patch under <folders path>/patches is scored by an svm refit without it (cross-validation folds with
+# the preset's scaler, pca and svm parameters), so the band is not picked on the svm's own training patches.
+# The configured blur backend verifies the patches those svms flag, and per flagged class the band with the
+# fewest cnn calls that keeps the target recall of the truly blurry patches (relative to verifying every
+# flagged patch) is kept.
+
+import os
+import argparse
+import numpy as np
+
+from resources.presets import preset_path, load_preset_file, save_preset_file, PRESET_SUFFIX, LEGACY_SUFFIX
+from resources.scoring import SklearnScorer
+from resources.gating import GATED_CLASSES, calibrate_band
+
+# labels and max decision scores of every patch from the svm fit on the other folds
+def out_of_fold_scores(svm, scaler, pca, features, labels, folds, seed=0):
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedKFold
+
+    features = np.asarray(features)
+    _, counts = np.unique(labels, return_counts=True)
+    folds = max(2, min(folds, int(counts.min())))
+
+    fold_labels = np.empty(len(labels), dtype=object)
+    scores = np.empty(len(labels), dtype=np.float64)
+    for train, held_out in StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(features, labels):
+        fold_scaler, fold_pca, fold_svm = clone(scaler), clone(pca), clone(svm)
+        reduced = fold_pca.fit_transform(fold_scaler.fit_transform(features[train]))
+        fold_svm.fit(reduced, labels[train])
+        fold_labels[held_out], scores[held_out] = SklearnScorer(fold_svm, fold_scaler, fold_pca).score(features[held_out])
+    return fold_labels, scores
+
+def calibrate_gating(preset_name, patches_path, target_recall, max_precision_loss, output_name=None, folds=5):
+    from resources.svm import load_training_features
+    from resources.cnn import load_blur_backend, predict_blur
+
+    svm, scaler, pca, metadata = load_preset_file(preset_path(preset_name), load_models=True, mmap=False)
+    training_patches, features, labels, _ = load_training_features(patches_path, metadata['features'])
+    labels = np.array(labels)
+
+    svm_labels, scores = out_of_fold_scores(svm, scaler, pca, features, labels, folds)
+
+    model = load_blur_backend()
+    gating = {'target_recall': target_recall, 'max_precision_loss': max_precision_loss, 'folds': folds, 'report': {}}
+    for patch_class in GATED_CLASSES:
+        flagged = np.flatnonzero(svm_labels == patch_class)
+        cnn_blurry = np.array(predict_blur([training_patches[i] for i in flagged], model), dtype=bool)
+
+        band, report = calibrate_band(scores[flagged], labels[flagged] == 'blurry', cnn_blurry, target_recall, max_precision_loss)
+        gating[patch_class] = band
+        gating['report'][patch_class] = report
+        print(f"{patch_class}: {report['patches']} flagged, reject below {band['reject_below']}, accept above {band['accept_above']}, "
+              f"cnn calls {report['cnn_calls']}/{report['patches']}"
+              + (f", recall {report['recall']:.4f}, precision {report['precision']:.4f} (ungated {report['ungated_precision']:.4f})" if 'recall' in report else ''))
+
+    # always saved in the .preset format, a .pkl preset is replaced by its conversion
+    output_name = output_name or preset_name
+    if output_name.endswith(LEGACY_SUFFIX):
+        output_name = output_name[:-len(LEGACY_SUFFIX)]
+    if not output_name.endswith(PRESET_SUFFIX):
+        output_name += PRESET_SUFFIX
+
+    metadata['gating'] = gating
+    save_preset_file(preset_path(output_name), svm, scaler, pca, metadata)
+    print(f'saved {output_name}')
+    return gating
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the cnn gating band of a preset.')
+    parser.add_argument('preset', help='preset name in the presets folder')
+    parser.add_argument('--target-recall', type=float, default=0.98, help='share of the truly blurry patches the ungated pipeline keeps that must still be kept')
+    parser.add_argument('--max-precision-loss', type=float, default=0.02)
+    parser.add_argument('--patches', default=os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH", ''), 'patches'))
+    parser.add_argument('--output', default=None, help='save under another preset name instead of replacing it')
+    parser.add_argument('--folds', type=int, default=5, help='cross-validation folds the patches are scored with')
+    args = parser.parse_args()
+
+    calibrate_gating(args.preset, args.patches, args.target_recall, args.max_precision_loss, args.output, args.folds)
+
+if __name__ == '__main__':
+    main()
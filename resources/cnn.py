@@ -1,29 +1,223 @@
 IMAGE_SIZE = 200
-from keras.api.preprocessing.image import img_to_array
+import os
 import cv2
 import numpy as np
 
-def predict_blur(images, model):
-    processed_images = []
-    for img in images:
-        #img = cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
-        img = img_to_array(img)
-        img = img / 255.0
-        img = np.expand_dims(img, axis=-1)  # Add a channel dimension for grayscale
-        processed_images.append(img)
-    
-    processed_images = np.array(processed_images)
-    predictions = model.predict(processed_images, verbose=0)
-    
-    return [pred[0] > pred[1] for pred in predictions]
-
-
-# if __name__ == '__main__':
-#     dataset_dir = '/media/michalis/T/cnn-training-data/patches/blurry'
-#     names = os.listdir(dataset_dir)
-#     shuffle(names)
-
-#     model = load_model('blur_detection_model.keras')
-
-#     for i in range(10):
-#         print(predict_blur(os.path.join(dataset_dir, names[0]), model))
\ No newline at end of file
+# tflite_runtime is the small interpreter package, tensorflow's own interpreter works the same way
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+# patches per model call, every call gets a batch of exactly this many so the model never sees a new shape
+def blur_chunk():
+    return int(os.getenv("INSPECTION_CLIENT_BLUR_CHUNK", "64"))
+
+# writes the patches straight into out (or a new (n, IMAGE_SIZE, IMAGE_SIZE, 1) float32 array) and scales
+# them in place, returns the first len(images) rows
+def preprocess(images, out=None):
+    if out is None or len(out) < len(images):
+        out = np.empty((len(images), IMAGE_SIZE, IMAGE_SIZE, 1), dtype=np.float32)
+    batch = out[:len(images)]
+    for i, img in enumerate(images):
+        if img.shape[:2] != (IMAGE_SIZE, IMAGE_SIZE):
+            img = cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+        batch[i, :, :, 0] = img
+    np.divide(batch, 255.0, out=batch)
+    return batch
+
+def predict_on_batch(model, batch):
+    if hasattr(model, 'predict_on_batch'):
+        return np.asarray(model.predict_on_batch(batch))
+    return np.asarray(model.predict(batch, verbose=0))
+
+def predict_blur(images, model, chunk=None):
+    chunk = chunk or blur_chunk()
+    if len(images) == 0:
+        return []
+
+    # one buffer for all chunks, the rows after a short last chunk keep old patches and are ignored
+    buffer = np.zeros((chunk, IMAGE_SIZE, IMAGE_SIZE, 1), dtype=np.float32)
+    results = []
+    for start in range(0, len(images), chunk):
+        count = len(preprocess(images[start:start + chunk], buffer))
+        predictions = predict_on_batch(model, buffer)[:count]
+        results.extend((predictions[:, 0] > predictions[:, 1]).tolist())
+
+    return results
+
+# patches per second of predict_blur with each chunk size, to pick INSPECTION_CLIENT_BLUR_CHUNK per machine
+def benchmark_chunks(model, patches, sizes, repeats=3):
+    import time
+
+    throughput = {}
+    for size in sizes:
+        predict_blur(patches[:size], model, chunk=size)  # first call with this shape traces the graph
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            predict_blur(patches, model, chunk=size)
+            best = min(best, time.perf_counter() - start)
+        throughput[size] = len(patches) / best
+    return throughput
+
+# ------------------------------------------------------------
+# tflite backend, the keras model exported once and run by the tflite interpreter on the cpu
+# ------------------------------------------------------------
+
+def keras_model_path():
+    return os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'blur_detection_model.keras')
+
+def tflite_model_path(int8=False):
+    return os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), f'blur_detection_model{"_int8" if int8 else ""}.tflite')
+
+# representative_patches are needed for int8, they set the quantization ranges of the activations; exported
+# through a SavedModel since from_keras_model fails on keras 3 models
+def export_tflite(output_path, int8=False, representative_patches=None):
+    import shutil
+    import tempfile
+    import tensorflow as tf
+    from keras.api.models import load_model
+
+    model = load_model(keras_model_path())
+    saved_model_path = tempfile.mkdtemp(prefix='blur_saved_model_')
+    try:
+        model.export(saved_model_path)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+        if int8:
+            if not representative_patches:
+                raise ValueError('int8 export needs representative patches')
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+            def representative_dataset():
+                for patch in representative_patches:
+                    yield [(np.asarray(patch, dtype=np.float32) / 255.0).reshape((1,) + tuple(model.input_shape[1:]))]
+            converter.representative_dataset = representative_dataset
+
+        tflite_model = converter.convert()
+    finally:
+        shutil.rmtree(saved_model_path, ignore_errors=True)
+
+    with open(output_path, 'wb') as file:
+        file.write(tflite_model)
+
+# same predict() as the keras model as far as predict_blur is concerned
+class TFLiteBlurModel:
+    def __init__(self, path, threads=None):
+        interpreter_class = Interpreter
+        if interpreter_class is None:
+            import tensorflow as tf
+            interpreter_class = tf.lite.Interpreter
+        self.interpreter = interpreter_class(model_path=path, num_threads=threads or os.cpu_count())
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def predict_on_batch(self, batch):
+        return self.predict(batch)
+
+    def predict(self, batch, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32).reshape((len(batch),) + tuple(self.input['shape'][1:]))
+        if self.batch_size != len(batch):
+            self.interpreter.resize_tensor_input(self.input['index'], [len(batch)] + list(self.input['shape'][1:]))
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(batch)
+
+        # fully quantized models take int8 in and give int8 out
+        scale, zero_point = self.input.get('quantization', (0.0, 0))
+        if self.input['dtype'] != np.float32 and scale:
+            batch = np.round(batch / scale + zero_point).astype(self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], batch)
+        self.interpreter.invoke()
+
+        output = self.interpreter.get_tensor(self.output['index'])
+        scale, zero_point = self.output.get('quantization', (0.0, 0))
+        if self.output['dtype'] != np.float32 and scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+def backend():
+    return os.getenv("INSPECTION_CLIENT_BLUR_BACKEND", "keras")
+
+# the model predict_blur runs with, by INSPECTION_CLIENT_BLUR_BACKEND: keras, tflite or tflite_int8
+# (a missing float tflite file is exported from the keras model, int8 needs the export below)
+def load_blur_backend(name=None):
+    name = name or backend()
+    if name == 'keras':
+        from keras.api.models import load_model
+        return load_model(keras_model_path())
+    if name in ('tflite', 'tflite_int8'):
+        int8 = name == 'tflite_int8'
+        path = tflite_model_path(int8)
+        if not os.path.exists(path):
+            if int8:
+                raise FileNotFoundError(f'{path} not found, export it with python -m resources.cnn --export --int8')
+            export_tflite(path)
+        return TFLiteBlurModel(path)
+    raise ValueError(f'unknown blur backend {name}')
+
+# share of patches where both backends agree, and the largest difference of their outputs
+def compare_backends(patches, model, reference):
+    batch = preprocess(patches)
+    outputs = predict_on_batch(model, batch)
+    reference_outputs = predict_on_batch(reference, batch)
+
+    labels = outputs[:, 0] > outputs[:, 1]
+    reference_labels = reference_outputs[:, 0] > reference_outputs[:, 1]
+    return float(np.mean(labels == reference_labels)), float(np.max(np.abs(outputs - reference_outputs)))
+
+def load_sample_patches(count, seed=0):
+    folder = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'patches')
+    paths = []
+    for category in ['blurry', 'sharp', 'empty', 'indeterminate']:
+        category_folder = os.path.join(folder, category)
+        if os.path.isdir(category_folder):
+            paths.extend(os.path.join(category_folder, name) for name in os.listdir(category_folder))
+
+    rng = np.random.default_rng(seed)
+    paths = [paths[i] for i in rng.permutation(len(paths))[:count]]
+    patches = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths]
+    return [patch for patch in patches if patch is not None and patch.shape == (IMAGE_SIZE, IMAGE_SIZE)]
+
+# Export the tflite models and check them against the keras model on the training patches, and measure
+# the throughput of the configured backend per chunk size:
+#
+#   python -m resources.cnn --export --int8 --parity 2000
+#   python -m resources.cnn --parity 0 --chunks 16 32 64 128 256
+#
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Export the blur cnn to tflite, check parity with keras and tune the chunk size.')
+    parser.add_argument('--export', action='store_true', help='(re)export the tflite model')
+    parser.add_argument('--int8', action='store_true', help='int8 quantized model, calibrated on the training patches')
+    parser.add_argument('--parity', type=int, default=1000, help='number of training patches compared, 0 to skip')
+    parser.add_argument('--chunks', type=int, nargs='*', default=[], help='report predict_blur throughput for these chunk sizes')
+    args = parser.parse_args()
+
+    path = tflite_model_path(args.int8)
+    if args.export or (args.parity and not os.path.exists(path)):
+        export_tflite(path, args.int8, load_sample_patches(500, seed=1) if args.int8 else None)
+        print(f'exported {path} ({os.path.getsize(path) / 1e6:.1f} MB)')
+
+    if args.parity:
+        patches = load_sample_patches(args.parity)
+        keras_model = load_blur_backend('keras')
+        lite_model = TFLiteBlurModel(path)
+
+        agreement, max_difference = compare_backends(patches, lite_model, keras_model)
+        print(f'{len(patches)} patches, label agreement {agreement:.4f}, max output difference {max_difference:.4f}')
+
+        for name, model in [('keras', keras_model), ('tflite', lite_model)]:
+            predict_blur(patches[:1], model)
+            start = time.perf_counter()
+            predict_blur(patches, model)
+            print(f'{name:>7} {1000 * (time.perf_counter() - start) / max(len(patches), 1):.2f} ms/patch')
+
+    if args.chunks:
+        patches = load_sample_patches(8 * max(args.chunks))
+        model = load_blur_backend()
+        print(f'{backend()} backend, {len(patches)} patches')
+        for size, rate in benchmark_chunks(model, patches, args.chunks).items():
+            print(f'{size:>6} {rate:>10.1f} patches/s')
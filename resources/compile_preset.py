@@ -0,0 +1,57 @@
+# Compiles an rbf preset into its kernel approximation, stored in the preset and picked up by the
+# usual preset loading path (INSPECTION_CLIENT_APPROXIMATION=0 goes back to the svm).
+#
+#   python -m resources.compile_preset LATEST-JUL25_19_16-RBF.preset --components 500
+#
+# The agreement with the svm is measured on the training patches under <folders path>/patches.
+
+import os
+import argparse
+
+from resources.presets import preset_path, load_preset_file, save_preset_file, PRESET_SUFFIX, LEGACY_SUFFIX
+from resources.scoring import fit_approximation, approximation_report, approximation_scorer, affine_preprocessing
+
+def compile_preset(preset_name, patches_path, components, min_agreement, output_name=None):
+    from resources.svm import load_training_features
+
+    svm, scaler, pca, metadata = load_preset_file(preset_path(preset_name), load_models=True, mmap=False)
+    _, features, _, _ = load_training_features(patches_path, metadata['features'])
+
+    approximation = fit_approximation(svm, scaler, pca, features, components=components)
+    report = approximation_report(approximation_scorer(*affine_preprocessing(scaler, pca), approximation), svm, scaler, pca, features)
+    approximation['report'] = report
+
+    print(f"{report['patches']} training patches, label agreement {report['label_agreement']:.4f}, "
+          f"score difference max {report['max_score_difference']:.4f} mean {report['mean_score_difference']:.4f}")
+    print(f"{report['svm_ms_per_1000']:.1f} ms per 1000 patches with the svm, "
+          f"{report['approximation_ms_per_1000']:.1f} ms with {len(approximation['landmarks'])} landmarks")
+
+    if report['label_agreement'] < min_agreement:
+        print(f'agreement below {min_agreement}, preset left unchanged')
+        return report
+
+    # always saved in the .preset format, a .pkl preset is replaced by its conversion
+    output_name = output_name or preset_name
+    if output_name.endswith(LEGACY_SUFFIX):
+        output_name = output_name[:-len(LEGACY_SUFFIX)]
+    if not output_name.endswith(PRESET_SUFFIX):
+        output_name += PRESET_SUFFIX
+
+    metadata['approximation'] = approximation
+    save_preset_file(preset_path(output_name), svm, scaler, pca, metadata)
+    print(f'saved {output_name}')
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the kernel approximation of an rbf preset.')
+    parser.add_argument('preset', help='preset file name in the presets folder')
+    parser.add_argument('--components', type=int, default=500, help='number of Nystroem landmarks')
+    parser.add_argument('--patches', default=os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH", ''), 'patches'))
+    parser.add_argument('--min-agreement', type=float, default=0.99, help='label agreement needed to save the preset')
+    parser.add_argument('--output', default=None, help='save under another preset name instead of replacing it')
+    args = parser.parse_args()
+
+    compile_preset(args.preset, args.patches, args.components, args.min_agreement, args.output)
+
+if __name__ == '__main__':
+    main()
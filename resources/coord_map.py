@@ -0,0 +1,62 @@
+import os
+import warnings
+import numpy as np
+
+COORD_MAP_VERSION = 1
+COORD_MAP_NAME = 'coord_map.tsv'
+COORD_MAP_HEADER = f'# inspection_client coord_map v{COORD_MAP_VERSION}\n'
+
+# the basename column is as wide as the longest basename in the map, a fixed width would cut longer ones
+def coord_map_dtype(width):
+    return np.dtype([
+        ('basename', f'U{max(width, 1)}'),
+        ('x0', np.int32),
+        ('y0', np.int32),
+        ('x1', np.int32),
+        ('y1', np.int32),
+    ])
+
+# one line per page half: basename, upper left x, y, lower right x, y
+def format_coords(basename, coords):
+    (x0, y0), (x1, y1) = coords
+    return f'{basename}\t{int(x0)}\t{int(y0)}\t{int(x1)}\t{int(y1)}\n'
+
+def write_coord_map(results, output_path):
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(COORD_MAP_HEADER)
+        for new_img_path, coords in results:
+            file.write(format_coords(os.path.basename(new_img_path), coords))
+    os.replace(tmp_path, output_path)
+
+# pages can be appended as soon as they are cut, the map stays readable at all times
+def append_coords(output_path, results):
+    if not os.path.exists(output_path):
+        write_coord_map(results, output_path)
+        return
+    with open(output_path, 'a', encoding='utf-8') as file:
+        file.write(''.join(format_coords(os.path.basename(new_img_path), coords) for new_img_path, coords in results))
+
+def load_coord_map(input_path):
+    with open(input_path, 'r', encoding='utf-8') as file:
+        lines = file.readlines()
+    if not lines or lines[0] != COORD_MAP_HEADER:
+        raise ValueError(f'unsupported coord map format in {input_path}')
+
+    lines = lines[1:]
+    width = max((len(line.split('\t', 1)[0]) for line in lines), default=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # an empty map is fine
+        frames = np.loadtxt(lines, dtype=coord_map_dtype(width), delimiter='\t', comments='#', ndmin=1)
+
+    # a page cut twice keeps its last coords
+    _, last = np.unique(frames['basename'][::-1], return_index=True)
+    return frames[len(frames) - 1 - last]
+
+# basename -> (upper left coords, scale_x, scale_y)
+def coord_scales_dict(frames, image_size):
+    scale_x = (frames['x1'] - frames['x0']) / image_size
+    scale_y = (frames['y1'] - frames['y0']) / image_size
+    top_left = np.stack([frames['x0'], frames['y0']], axis=1).tolist()
+
+    return dict(zip(frames['basename'].tolist(), zip(top_left, scale_x.tolist(), scale_y.tolist())))
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import numpy as np
+from resources.log import LoggerSingleton
+from resources.retry import retry_makedirs
+
+CACHE_VERSION = 1
+
+# per book store of patch features, under <folders path>/feature_cache/<name>:
+#   index.json             { 'version', 'features_file', 'entries': { key: [start, stop, columns] } }
+#   features_<n>.npy       all rows flattened one after the other, memory mapped by the readers
+#   pending/<key>.npy      rows written by the workers, merged into the next features file by consolidate()
+class FeatureCache:
+    def __init__(self, name):
+        self.path = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'feature_cache', name)
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.pending_path = os.path.join(self.path, 'pending')
+        self.entries = {}
+        self.features = None
+        self.index_mtime = None
+
+    # the key covers the pixels, the grid and the feature set, so a changed one of them is a miss
+    @staticmethod
+    def key(image, grid_size, feature_version):
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+        digest.update(f'{image.shape}|{grid_size}|{feature_version}'.encode())
+        return digest.hexdigest()
+
+    def load(self):
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            return
+        if mtime == self.index_mtime:
+            return
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+            if index.get('version') != CACHE_VERSION:
+                return
+            self.features = np.load(os.path.join(self.path, index['features_file']), mmap_mode='r')
+            self.entries = index['entries']
+            self.index_mtime = mtime
+        except Exception as e:
+            print(f'(FeatureCache-l) {e}')
+            LoggerSingleton().error('(FeatureCache-l) ' + str(e))
+
+    # pending rows first, they are newer than the consolidated ones (a row filled in later)
+    def get(self, key):
+        pending = os.path.join(self.pending_path, key + '.npy')
+        if os.path.exists(pending):
+            try:
+                return np.load(pending)
+            except Exception:
+                pass
+
+        self.load()
+        entry = self.entries.get(key)
+        if entry is not None:
+            return np.array(self.features[entry[0]:entry[1]]).reshape(-1, entry[2])
+        return None
+
+    def put(self, key, rows):
+        try:
+            retry_makedirs(self.pending_path)
+            tmp_path = os.path.join(self.pending_path, key + '.tmp')
+            with open(tmp_path, 'wb') as file:
+                np.save(file, np.asarray(rows, dtype=np.float64))
+            os.replace(tmp_path, os.path.join(self.pending_path, key + '.npy'))
+        except Exception as e:
+            print(f'(FeatureCache-p) {e}')
+            LoggerSingleton().error('(FeatureCache-p) ' + str(e))
+
+    # merges the pending rows into a new features file, a pending key replaces its consolidated rows;
+    # only called by one process at a time
+    def consolidate(self):
+        if not os.path.isdir(self.pending_path):
+            return
+        pending = [name for name in os.listdir(self.pending_path) if name.endswith('.npy')]
+        if not pending:
+            return
+
+        self.index_mtime = None
+        self.load()
+        rows_by_key = {}
+        for name in pending:
+            try:
+                rows_by_key[name[:-4]] = np.load(os.path.join(self.pending_path, name))
+            except Exception:
+                continue
+
+        blocks = []
+        entries = {}
+        start = 0
+        for key, entry in self.entries.items():
+            if key in rows_by_key:
+                continue
+            blocks.append(np.asarray(self.features[entry[0]:entry[1]]))
+            entries[key] = [start, start + entry[1] - entry[0], entry[2]]
+            start += entry[1] - entry[0]
+
+        for key, rows in rows_by_key.items():
+            entries[key] = [start, start + rows.size, rows.shape[1] if rows.ndim == 2 else 1]
+            blocks.append(rows.ravel())
+            start += rows.size
+
+        if len(blocks) == 0:
+            return
+
+        # a new file each time, readers may still have the old one mapped
+        number = 0
+        while os.path.exists(os.path.join(self.path, f'features_{number}.npy')):
+            number += 1
+        features_file = f'features_{number}.npy'
+        np.save(os.path.join(self.path, features_file), np.concatenate(blocks))
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': CACHE_VERSION, 'features_file': features_file, 'entries': entries}, file)
+        os.replace(tmp_path, self.index_path)
+
+        for name in pending:
+            try:
+                os.remove(os.path.join(self.pending_path, name))
+            except OSError:
+                pass
+
+        self.features = None
+        self.index_mtime = None
+        for name in os.listdir(self.path):
+            if name.startswith('features_') and name.endswith('.npy') and name != features_file:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass  # still mapped somewhere, removed next time
+
+# one cache object per book and process
+_caches = {}
+
+def enabled():
+    return os.getenv("INSPECTION_CLIENT_FEATURE_CACHE", "1") == "1"
+
+def get_cache(name):
+    if name not in _caches:
+        _caches[name] = FeatureCache(name)
+    return _caches[name]
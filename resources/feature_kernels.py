@@ -0,0 +1,54 @@
+import numpy as np
+
+# Exact shortcuts for graycoprops(graycomatrix(patch, [1], [0], 256, symmetric=True, normed=True), prop).
+# With one distance and one angle the symmetric normed matrix is just the histogram of the horizontally
+# adjacent pixel pairs, so every prop that only depends on |i - j| is a mean over those pairs.
+
+def horizontal_differences(patches):
+    patches = np.asarray(patches)
+    return patches[..., :, 1:].astype(np.int32) - patches[..., :, :-1].astype(np.int32)
+
+def glcm_contrast(patches):
+    diff = horizontal_differences(patches)
+    return (diff * diff).mean(axis=(-2, -1))
+
+def glcm_dissimilarity(patches):
+    return np.abs(horizontal_differences(patches)).mean(axis=(-2, -1))
+
+def glcm_homogeneity(patches):
+    diff = horizontal_differences(patches)
+    return (1.0 / (1.0 + diff * diff)).mean(axis=(-2, -1))
+
+# the same names graycoprops uses, each kernel takes one patch or a stack of equally sized patches
+KERNELS = {
+    'contrast': glcm_contrast,
+    'dissimilarity': glcm_dissimilarity,
+    'homogeneity': glcm_homogeneity,
+}
+
+def glcm_prop(patches, prop):
+    return KERNELS[prop](patches)
+
+# largest absolute difference between every kernel and the skimage reference over the given patches
+def compare_with_skimage(patches):
+    from skimage.feature import graycomatrix, graycoprops
+
+    errors = {}
+    for prop, kernel in KERNELS.items():
+        error = 0.0
+        for patch in patches:
+            glcm = graycomatrix(patch, [1], [0], 256, symmetric=True, normed=True)
+            error = max(error, abs(float(graycoprops(glcm, prop)[0, 0]) - float(kernel(patch))))
+        errors[prop] = error
+    return errors
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    patches = [rng.integers(0, 256, (200, 200), dtype=np.uint8) for _ in range(20)]
+    patches += [np.full((200, 200), 128, dtype=np.uint8), np.tile(np.arange(200, dtype=np.uint8), (200, 1))]
+
+    errors = compare_with_skimage(patches)
+    for prop, error in errors.items():
+        print(f'{prop:>14} max abs error {error:.3e}')
+    if max(errors.values()) > 1e-9:
+        raise SystemExit('kernels do not match skimage')
@@ -0,0 +1,74 @@
+import os
+import time
+import functools
+import threading
+from resources.retry import retry_makedirs
+
+# read once at import, when it is off the timed functions are left untouched
+ENABLED = os.getenv("INSPECTION_CLIENT_FEATURE_TIMING", "0") == "1"
+
+# name -> [self seconds, calls, total seconds], per process. Self time leaves out the timed functions called
+# from inside, so the self times of all names add up to the time spent in timed code.
+_totals = {}
+
+# the seconds spent in nested timed calls, one entry per timed call in progress on this thread
+_nested = threading.local()
+
+def timed(name):
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = _nested.__dict__.setdefault('stack', [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                entry = _totals.setdefault(name, [0.0, 0, 0.0])
+                entry[0] += elapsed - nested
+                entry[1] += 1
+                entry[2] += elapsed
+        return wrapper
+    return decorator
+
+# hands the counters of this worker to the parent and starts over
+def drain():
+    global _totals
+    if not ENABLED:
+        return None
+    totals, _totals = _totals, {}
+    return totals
+
+def merge(into, totals):
+    if not totals:
+        return into
+    for name, (seconds, calls, total) in totals.items():
+        entry = into.setdefault(name, [0.0, 0, 0.0])
+        entry[0] += seconds
+        entry[1] += calls
+        entry[2] += total
+    return into
+
+def write_summary(barcode, totals):
+    if not totals:
+        return
+    folder = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'timings')
+    retry_makedirs(folder)
+
+    # shares of the self time, nested calls are not counted twice
+    overall = sum(seconds for seconds, _, _ in totals.values()) or 1.0
+    lines = [f'{"feature":<28} {"calls":>9} {"self s":>10} {"total s":>10} {"mean ms":>10} {"share":>7}']
+    for name, (seconds, calls, total) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True):
+        lines.append(f'{name:<28} {calls:>9} {seconds:>10.2f} {total:>10.2f} {1000 * total / max(calls, 1):>10.3f} {100 * seconds / overall:>6.1f}%')
+
+    summary = '\n'.join(lines)
+    print(f'{barcode} feature timings:\n{summary}')
+    with open(os.path.join(folder, f'{barcode}_features.txt'), 'w') as file:
+        file.write(summary + '\n')
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+# Confidence gate in front of the blur cnn, stored with the preset as metadata['gating']:
+#   { 'blurry': { 'reject_below': s or None, 'accept_above': s or None }, 'indeterminate': { ... },
+#     'target_recall': r, 'report': { ... } }
+# A patch the svm labeled with one of these classes is kept without the cnn when its decision score is at
+# least accept_above, dropped without the cnn below reject_below, and only the band in between is verified.
+GATED_CLASSES = ('blurry', 'indeterminate')
+
+def gating_enabled():
+    return os.getenv("INSPECTION_CLIENT_CNN_GATING", "1") == "1"
+
+def gate(label, score, gating):
+    band = (gating or {}).get(label)
+    if band is None or not gating_enabled():
+        return 'verify'
+    if band.get('accept_above') is not None and score >= band['accept_above']:
+        return 'accept'
+    if band.get('reject_below') is not None and score < band['reject_below']:
+        return 'reject'
+    return 'verify'
+
+# labeled patches the gate keeps outright, and the ones left for the cnn, the rejected ones are dropped
+def split_by_gate(labeled_patches, gating):
+    accepted = []
+    uncertain = []
+    for labeled_patch in labeled_patches:
+        decision = gate(labeled_patch[2], labeled_patch[3], gating)
+        if decision == 'accept':
+            accepted.append(labeled_patch)
+        elif decision == 'verify':
+            uncertain.append(labeled_patch)
+    return accepted, uncertain
+
+# patches kept by the svm + gate + cnn pipeline for one band
+def kept_by_band(scores, cnn_blurry, reject_below, accept_above):
+    accepted = scores >= accept_above
+    verified = ~accepted & (scores >= reject_below) & cnn_blurry
+    return accepted | verified
+
+# the band of one svm class with the fewest cnn calls that keeps at least target_recall of the truly blurry
+# patches the ungated pipeline keeps, and loses at most max_precision_loss of its precision.
+# scores: svm decision scores of the patches the svm gave this class, blurry: their true labels,
+# cnn_blurry: what the cnn says about them
+def calibrate_band(scores, blurry, cnn_blurry, target_recall, max_precision_loss=0.02, candidates=41):
+    scores = np.asarray(scores, dtype=np.float64)
+    blurry = np.asarray(blurry, dtype=bool)
+    cnn_blurry = np.asarray(cnn_blurry, dtype=bool)
+
+    report = {'patches': int(len(scores)), 'truly_blurry': int(blurry.sum())}
+    if len(scores) == 0 or not (cnn_blurry & blurry).any():
+        report['cnn_calls'] = report['patches']
+        return {'reject_below': None, 'accept_above': None}, report
+
+    full_kept = cnn_blurry
+    full_true = (full_kept & blurry).sum()
+    full_precision = full_true / full_kept.sum()
+
+    thresholds = np.unique(np.quantile(scores, np.linspace(0, 1, candidates)))
+    lows = np.concatenate([[-np.inf], thresholds])
+    highs = np.concatenate([thresholds, [np.inf]])
+
+    best = (-np.inf, np.inf)
+    best_calls = len(scores)
+    for low in lows:
+        for high in highs:
+            if high < low:
+                continue
+            calls = int(((scores >= low) & (scores < high)).sum())
+            if calls >= best_calls:
+                continue
+            kept = kept_by_band(scores, cnn_blurry, low, high)
+            recall = (kept & blurry).sum() / full_true
+            precision = (kept & blurry).sum() / max(kept.sum(), 1)
+            if recall >= target_recall and precision >= full_precision - max_precision_loss:
+                best, best_calls = (low, high), calls
+
+    kept = kept_by_band(scores, cnn_blurry, *best)
+    report.update({
+        'cnn_calls': best_calls,
+        'cnn_call_share': best_calls / len(scores),
+        'recall': float((kept & blurry).sum() / full_true),
+        'precision': float((kept & blurry).sum() / max(kept.sum(), 1)),
+        'ungated_precision': float(full_precision),
+    })
+    band = {
+        'reject_below': None if np.isinf(best[0]) else float(best[0]),
+        'accept_above': None if np.isinf(best[1]) else float(best[1]),
+    }
+    return band, report
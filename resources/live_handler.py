@@ -1,19 +1,27 @@
 import os
 from PyQt5.QtWidgets import QWidget
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, QTimer
-from multiprocessing import Process, Queue, Value, Lock, cpu_count
+from multiprocessing import Process, Queue, Value, Lock, Event, cpu_count
 from resources.utils import process_and_save_image
 from resources.svm import read_divide_classify
-import joblib
+from resources import worker_pool, blur_service
+from resources.presets import check_preset, preset_gating
+from resources.gating import split_by_gate
+from resources.log import LoggerSingleton
 
-def temp_image_worker_process(path_queue, image_queue, folder_path, temp_images_path):
+# seconds each worker gets to leave on its stop signal
+WORKER_JOIN_TIMEOUT = 10
+
+def temp_image_worker_process(path_queue, image_queue, folder_path, temp_images_path, stop_event):
     #print('PLEASE')
     while True:
         try:
             image_name = path_queue.get()  # Blocking until new image arrives
             # print(f'new image {image_name}')
             # print('wtf')
-            if image_name is None:  # Stop signal
+            if image_name is None or stop_event.is_set():  # Stop signal
+                # what is still buffered for the next stage is dropped, or the exit waits for a reader that is gone
+                image_queue.cancel_join_thread()
                 break
             # print('wtf!')
             halfs, paths, num = process_and_save_image(os.path.basename(image_name), folder_path, temp_images_path, return_images=True)
@@ -22,18 +30,22 @@ def temp_image_worker_process(path_queue, image_queue, folder_path, temp_images_
         except Exception as e:
             print(f'exeption {e}')
 
-def inspect_worker_process(image_queue, labeled_patches_queue, svm, pca, scaler):
+def inspect_worker_process(image_queue, labeled_patches_queue, preset_name, stop_event):
     """Process each image in the queue: generate temp images, run SVM, and filter with Keras model."""
     while True:
         item = image_queue.get()  # Blocking until new image arrives
-        if item is None:  # Stop signal
+        if item is None or stop_event.is_set():  # Stop signal
+            labeled_patches_queue.cancel_join_thread()
             break
         halfs, paths, num = item
         #print(f'new halfs')
+        # loaded in this process on the first image, and again only when the preset file changes
+        svm, scaler, pca, metadata = worker_pool.get_preset(preset_name)
+        scorer = worker_pool.get_scorer(preset_name)
         total_labeled_patches = []
 
         for half, i in zip(halfs, range(2)):
-            labeled_patches = read_divide_classify(num, svm, pca, scaler, image=half)
+            labeled_patches = read_divide_classify(num, svm, pca, scaler, image=half, metadata=metadata, scorer=scorer)
             
             if i == 1:
                 for labeled_patch in labeled_patches:
@@ -46,28 +58,36 @@ def inspect_worker_process(image_queue, labeled_patches_queue, svm, pca, scaler)
 
         labeled_patches_queue.put((total_labeled_patches, paths, num))
 
-def classify_patches_worker_process(labeled_patches_queue, results_queue, model):
-    from resources.cnn import predict_blur
+def classify_patches_worker_process(labeled_patches_queue, results_queue, blur_client, stop_event, gating=None):
     while True:
         item = labeled_patches_queue.get()  # Blocking until new image arrives
-        if item is None:  # Stop signal
+        if item is None or stop_event.is_set():  # Stop signal
+            results_queue.cancel_join_thread()
             break
         labeled_patches, half_paths, num = item
         #print(f'new labeled_patches')
         n = len(labeled_patches)
-        patches = [labeled_patches[i][0] for i in range(len(labeled_patches))]
+        # patches outside the preset's gating band are kept or dropped on their svm score alone
+        accepted, uncertain = split_by_gate(labeled_patches, gating)
+        patches = [uncertain[i][0] for i in range(len(uncertain))]
         
-        results = predict_blur(patches, model)
+        try:
+            results = blur_client.predict(patches)
+        except Exception as e:
+            # the uncertain patches keep their svm labels
+            print(f'(Live-cp) {e}')
+            LoggerSingleton().error('(Live-cp) ' + str(e))
+            results = [True] * len(patches)
 
-        count = sum(results)
+        count = sum(results) + len(accepted)
 
-        print(f'number of blurries: {count} / {n}')
+        print(f'number of blurries: {count} / {n} ({len(uncertain)} verified by the cnn)')
 
-        new_labeled_patches = []
+        new_labeled_patches = list(accepted)
         
-        for i in range(len(labeled_patches)):
+        for i in range(len(uncertain)):
             if results[i]:
-                new_labeled_patches.append(labeled_patches[i])
+                new_labeled_patches.append(uncertain[i])
         
         new_labeled_patches.append(half_paths)
         new_labeled_patches.append(num)
@@ -79,15 +99,16 @@ class LiveHandler(QObject):
     result_ready = pyqtSignal(list)  # str: image path, dict: filtered results
 
     def __init__(self, selected_preset):
-        from keras.api.preprocessing.image import img_to_array
-        from keras.api.models import load_model
-
         super().__init__()
-        self.model = load_model(os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'blur_detection_model.keras'))
+        # already warm in the shared inference service, nothing to load here
+        self.blur_client = blur_service.get_client('live')
         self.image_queue = Queue()
         self.path_queue = Queue()
         self.labeled_patches_queue = Queue()
         self.results_queue = Queue()
+        # set on stop so the workers skip whatever is still queued and leave at their next item
+        self.stop_event = Event()
+        self.worker_processes = []
         self.temp_image_worker = None
         self.inspect_worker = None
         self.classify_patches_worker = None
@@ -95,8 +116,10 @@ class LiveHandler(QObject):
         self.folder_path = None
         self.temp_folder_path = None
 
-        preset_path = os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets', selected_preset)
-        self.svm, self.scaler, self.pca = joblib.load(preset_path)
+        # the inspect worker loads the preset itself, only its name is passed on
+        self.preset_name = selected_preset
+        check_preset(selected_preset)
+        self.gating = preset_gating(selected_preset)
         
         # Set up a timer to regularly check the results queue
         self.timer = QTimer()
@@ -112,13 +135,13 @@ class LiveHandler(QObject):
     def start_watching(self, folder_path, temp_folder_path):
         self.folder_path = folder_path
         self.temp_folder_path = temp_folder_path
-        self.temp_image_worker = Process(target=temp_image_worker_process, args=(self.path_queue, self.image_queue, self.folder_path, self.temp_folder_path,))
+        self.temp_image_worker = Process(target=temp_image_worker_process, args=(self.path_queue, self.image_queue, self.folder_path, self.temp_folder_path, self.stop_event,), daemon=True)
         self.temp_image_worker.start()
         
-        self.inspect_worker = Process(target=inspect_worker_process, args=(self.image_queue, self.labeled_patches_queue, self.svm, self.pca, self.scaler,))
+        self.inspect_worker = Process(target=inspect_worker_process, args=(self.image_queue, self.labeled_patches_queue, self.preset_name, self.stop_event,), daemon=True)
         self.inspect_worker.start()
         
-        self.classify_patches_worker = Process(target=classify_patches_worker_process, args=(self.labeled_patches_queue, self.results_queue, self.model,))
+        self.classify_patches_worker = Process(target=classify_patches_worker_process, args=(self.labeled_patches_queue, self.results_queue, self.blur_client, self.stop_event, self.gating,), daemon=True)
         self.classify_patches_worker.start()
 
         self.worker_processes = [self.temp_image_worker, self.inspect_worker, self.classify_patches_worker]
@@ -126,9 +149,21 @@ class LiveHandler(QObject):
 
     def stop_watching(self):
         """Stop all worker processes."""
+        # each worker leaves on its stop signal once the item in hand is done, the ones that don't are
+        # terminated, except the classify worker: killed inside put() it can leave the blur service's shared
+        # requests queue unusable, it is a daemon and leaves by itself when its blur request returns
+        self.stop_event.set()
+        for worker_queue in (self.path_queue, self.image_queue, self.labeled_patches_queue):
+            worker_queue.put(None)
         for process in self.worker_processes:
-            process.terminate()
-            process.join()
+            process.join(timeout=WORKER_JOIN_TIMEOUT)
+            if not process.is_alive():
+                continue
+            if process is self.classify_patches_worker:
+                LoggerSingleton().error('(Live-sw) classify worker still waiting for the blur service, left to finish')
+            else:
+                process.terminate()
+                process.join()
         self.worker_processes = []
 
         self.timer.stop()
@@ -142,7 +177,4 @@ class LiveHandler(QObject):
     @pyqtSlot()
     def stop(self):
         """Stop all processes and clean up."""
-        self.path_queue.put(None)
-        self.image_queue.put(None)
-        self.labeled_patches_queue.put(None)
         self.stop_watching()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+from resources.log import LoggerSingleton
+from resources.coord_map import COORD_MAP_NAME
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+# the settings the halfs are cut with, halfs cut with other settings are cut again
+def cut_parameters():
+    return {
+        'image_size': os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE"),
+        'boundary_tolerance': os.getenv("INSPECTION_CLIENT_BOUNDARY_TOLERANCE", "0"),
+    }
+
+# keeps track of which source tifs of a book are already cut into temp_images/<barcode>
+# { 'version', 'cut': cut_parameters(),
+#   'entries': { tif filename: { 'size', 'mtime', 'hash', 'halfs': [ [half path, coords], ... ] } } }
+class CutManifest:
+    def __init__(self, temp_images_path, use_hash=os.getenv("INSPECTION_CLIENT_MANIFEST_HASH", "0") == "1"):
+        self.temp_images_path = temp_images_path
+        self.path = os.path.join(temp_images_path, MANIFEST_NAME)
+        self.use_hash = use_hash
+        self.cut = cut_parameters()
+        self.entries = {}
+        self.dirty = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            if data.get('version') == MANIFEST_VERSION and data.get('cut') == self.cut:
+                self.entries = data['entries']
+        except Exception as e:
+            print(f'(Manifest-l) {e}')
+            LoggerSingleton().error('(Manifest-l) ' + str(e))
+            self.entries = {}
+        return self
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': MANIFEST_VERSION, 'cut': self.cut, 'entries': self.entries}, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = 0
+
+    def source_state(self, image_path):
+        stat = os.stat(image_path)
+        state = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None}
+        if self.use_hash:
+            sha = hashlib.sha1()
+            with open(image_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    sha.update(chunk)
+            state['hash'] = sha.hexdigest()
+        return state
+
+    # a tif is valid if it did not change since it was cut and all of its halfs are still on disk
+    def is_valid(self, filename, images_path):
+        entry = self.entries.get(filename)
+        if entry is None or not entry['halfs']:
+            return False
+        try:
+            state = self.source_state(os.path.join(images_path, filename))
+        except OSError:
+            return False
+        if entry['size'] != state['size'] or entry['mtime'] != state['mtime']:
+            return False
+        if self.use_hash and entry['hash'] != state['hash']:
+            return False
+        for path, _ in entry['halfs']:
+            full_path = os.path.join(self.temp_images_path, os.path.basename(path))
+            if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
+                return False
+        return True
+
+    def update(self, filename, images_path, halfs, save_every=10):
+        entry = self.source_state(os.path.join(images_path, filename))
+        entry['halfs'] = [[path, [list(coords[0]), list(coords[1])]] for path, coords in halfs]
+        self.entries[filename] = entry
+        self.dirty += 1
+        if self.dirty >= save_every:
+            self.save()
+
+    # drops everything that is not a valid cut of one of the given tifs, returns the tifs left to cut
+    def prepare(self, filenames, images_path):
+        valid = [filename for filename in filenames if self.is_valid(filename, images_path)]
+        self.entries = {filename: self.entries[filename] for filename in valid}
+
+        kept = {MANIFEST_NAME, COORD_MAP_NAME}
+        for entry in self.entries.values():
+            kept.update(os.path.basename(path) for path, _ in entry['halfs'])
+
+        for name in os.listdir(self.temp_images_path):
+            if name not in kept:
+                os.remove(os.path.join(self.temp_images_path, name))
+
+        self.save()
+        return [filename for filename in filenames if filename not in self.entries]
+
+    def results(self):
+        return [(path, (coords[0], coords[1])) for filename in sorted(self.entries) for path, coords in self.entries[filename]['halfs']]
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import shutil
+import joblib
+import numpy as np
+from resources.features import DEFAULT_FEATURES, check_feature_names
+from resources.log import LoggerSingleton
+from resources.retry import retry_makedirs, retry_on_exception
+
+# A preset is a directory <name>.preset:
+#   header.json      schema version, training parameters, feature names, classes, cascade, approximation,
+#                    and 'version', the subdirectory holding the files below
+#   <version>/<array>.npy   scorer arrays (see scoring.scorer_arrays) and the approximation, memory mapped on load
+#   <version>/model.joblib  (svm, scaler, pca), only loaded for training tools and presets without scorer arrays
+# Every save writes a new version and then replaces header.json, files that are mapped are never moved or
+# overwritten (Windows refuses that while a reader holds the mapping), older versions are removed once nothing
+# maps them anymore.
+# Presets from before are single .pkl files, (svm, scaler, pca) or (svm, scaler, pca, metadata), and are
+# converted the first time the presets are listed.
+PRESET_SUFFIX = '.preset'
+LEGACY_SUFFIX = '.pkl'
+SCHEMA_VERSION = 1
+HEADER_NAME = 'header.json'
+MODEL_NAME = 'model.joblib'
+
+def presets_folder():
+    return os.path.join(os.getenv("INSPECTION_CLIENT_FOLDERS_PATH"), 'presets')
+
+def preset_path(preset_name):
+    return os.path.join(presets_folder(), preset_name)
+
+def is_preset_dir(path):
+    return os.path.isfile(os.path.join(path, HEADER_NAME))
+
+# changes whenever the preset is saved again, for the caches of loaded presets
+def preset_mtime(path):
+    return os.path.getmtime(os.path.join(path, HEADER_NAME) if os.path.isdir(path) else path)
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_NAME), 'r') as file:
+        header = json.load(file)
+    if header.get('schema_version') != SCHEMA_VERSION:
+        raise ValueError(f'{os.path.basename(path)}: preset schema {header.get("schema_version")}, expected {SCHEMA_VERSION}')
+    return header
+
+# the directory with the arrays and the model, presets saved before versions have them next to the header
+def version_path(path, header):
+    return os.path.join(path, header['version']) if header.get('version') else path
+
+# raises when the preset cannot be used with the current grid and image size, before any work starts
+def check_preset(preset_name):
+    path = preset_path(preset_name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{preset_name} not found')
+    if not is_preset_dir(path):
+        return
+
+    header = read_header(path)
+    expected = {'grid_size': os.getenv("INSPECTION_CLIENT_GRID_SIZE"), 'image_size': os.getenv("INSPECTION_CLIENT_TEMP_IMAGE_SIZE")}
+    for name, value in expected.items():
+        if header.get(name) is not None and value is not None and int(header[name]) != int(value):
+            raise ValueError(f'{preset_name} was trained with {name} {header[name]}, the current {name} is {value}')
+
+# the cnn gating band of a preset (see gating.py), None when it was never calibrated
+def preset_gating(preset_name):
+    path = preset_path(preset_name)
+    if is_preset_dir(path):
+        return read_header(path).get('gating')
+    return load_preset_file(path)[3].get('gating')
+
+# (svm, scaler, pca, metadata)
+# metadata: { 'features': [...], 'cascade': thresholds of the early exit cascade, 'approximation': compiled rbf model,
+#             'gating': cnn gating band }, all but features optional
+# for .preset directories also the header fields and 'arrays', and svm, scaler and pca are None unless
+# load_models is set or the preset has no scorer arrays
+# mmap=False reads the arrays into memory, for the offline tools that save over the preset they loaded
+def load_preset_file(path, load_models=False, mmap=True):
+    if os.path.isdir(path):
+        return load_preset_dir(path, load_models, mmap)
+
+    data = joblib.load(path)
+    if len(data) == 3:
+        svm, scaler, pca = data
+        metadata = {}
+    else:
+        svm, scaler, pca, metadata = data
+
+    metadata = dict(metadata)
+    metadata['features'] = check_feature_names(metadata.get('features', DEFAULT_FEATURES))
+    return svm, scaler, pca, metadata
+
+def load_preset_dir(path, load_models=False, mmap=True):
+    from resources.scoring import fused_scoring_enabled
+
+    header = read_header(path)
+    files_path = version_path(path, header)
+    arrays = {name: np.load(os.path.join(files_path, name + '.npy'), mmap_mode='r' if mmap else None) for name in header['arrays']}
+
+    metadata = dict(header)
+    metadata['features'] = check_feature_names(header['features'])
+    metadata['classes'] = np.asarray(header['classes'])
+    metadata['arrays'] = {name: array for name, array in arrays.items() if not name.startswith('approximation_')}
+    if header.get('approximation') is not None:
+        approximation = dict(header['approximation'], classes=metadata['classes'])
+        for name, array in arrays.items():
+            if name.startswith('approximation_'):
+                approximation[name[len('approximation_'):]] = array
+        metadata['approximation'] = approximation
+
+    svm = scaler = pca = None
+    if load_models or not metadata['arrays'] or not fused_scoring_enabled():
+        svm, scaler, pca = joblib.load(os.path.join(files_path, MODEL_NAME))
+    return svm, scaler, pca, metadata
+
+@retry_on_exception
+def replace_header(tmp_path, header_path):
+    os.replace(tmp_path, header_path)
+
+# path is the .preset directory, the new version is complete before header.json points to it
+def save_preset_file(path, svm, scaler, pca, metadata):
+    from sklearn import __version__ as sklearn_version
+    from resources.scoring import can_fuse, scorer_arrays
+
+    arrays, gamma = scorer_arrays(svm, scaler, pca) if can_fuse(svm) else ({}, None)
+    approximation = metadata.get('approximation')
+    header_approximation = None
+    if approximation is not None:
+        header_approximation = {name: value for name, value in approximation.items() if name not in ('landmarks', 'weights', 'bias', 'classes')}
+        for name in ('landmarks', 'weights', 'bias'):
+            arrays['approximation_' + name] = approximation[name]
+
+    version = f'v{int(time.time() * 1000)}'
+    header = {
+        'schema_version': SCHEMA_VERSION,
+        'version': version,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'sklearn_version': sklearn_version,
+        'grid_size': metadata.get('grid_size'),
+        'image_size': metadata.get('image_size'),
+        'features': list(metadata['features']),
+        'classes': [str(name) for name in svm.classes_],
+        'kernel': svm.kernel,
+        'gamma': gamma,
+        'cascade': metadata.get('cascade'),
+        'approximation': header_approximation,
+        'gating': metadata.get('gating'),
+        'arrays': sorted(arrays),
+    }
+
+    files_path = os.path.join(path, version)
+    retry_makedirs(files_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(files_path, name + '.npy'), np.ascontiguousarray(array, dtype=np.float64))
+    joblib.dump((svm, scaler, pca), os.path.join(files_path, MODEL_NAME))
+
+    header_path = os.path.join(path, HEADER_NAME)
+    previous = read_header(path).get('version') if is_preset_dir(path) else None
+    with open(header_path + '.tmp', 'w') as file:
+        json.dump(header, file, indent=2)
+    replace_header(header_path + '.tmp', header_path)
+
+    remove_old_versions(path, (version, previous))
+
+# the previous version stays for a reader that read the old header just before it was replaced (the files of
+# a preset saved before versions are its previous version until the next save), versions still mapped by a reader fail to delete on Windows and are tried again on the next save
+def remove_old_versions(path, keep):
+    for name in os.listdir(path):
+        old_path = os.path.join(path, name)
+        if name in keep:
+            continue
+        if name.startswith('v') and os.path.isdir(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+        elif None not in keep and (name.endswith('.npy') or name == MODEL_NAME):
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+# preset names for the preset lists, .pkl presets without a .preset are converted first and the ones
+# that fail stay listed as .pkl
+def list_presets():
+    folder = presets_folder()
+    retry_makedirs(folder)
+
+    names = []
+    for filename in os.listdir(folder):
+        if not filename.endswith(LEGACY_SUFFIX):
+            continue
+        converted = filename[:-len(LEGACY_SUFFIX)] + PRESET_SUFFIX
+        if is_preset_dir(os.path.join(folder, converted)):
+            continue
+        try:
+            save_preset_file(os.path.join(folder, converted), *load_preset_file(os.path.join(folder, filename)))
+            print(f'converted preset {filename} to {converted}')
+        except Exception as e:
+            print(f'(Presets-lp) {filename}: {e}')
+            LoggerSingleton().error(f'(Presets-lp) {filename}: {e}')
+            names.append(filename)
+
+    for filename in os.listdir(folder):
+        if filename.endswith(PRESET_SUFFIX) and is_preset_dir(os.path.join(folder, filename)):
+            names.append(filename)
+    return sorted(names)
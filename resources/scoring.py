@@ -0,0 +1,224 @@
+import os
+import copy
+import time
+import numpy as np
+
+# Scorers give the labels and the max decision scores of a batch of raw feature rows, the same values
+# svm.predict and the max of svm.decision_function give after scaler.transform and pca.transform.
+# Apart from SklearnScorer they only hold numpy arrays, which the preset format stores memory mapped.
+
+# scaler -> pca -> svm of sklearn, what every preset can do
+class SklearnScorer:
+    def __init__(self, svm, scaler, pca):
+        self.svm = svm
+        self.scaler = scaler
+        self.pca = pca
+
+    def score(self, features):
+        transformed = self.pca.transform(self.scaler.transform(features))
+        labels = self.svm.predict(transformed)
+        decision_scores = np.asarray(self.svm.decision_function(transformed)).reshape(len(labels), -1)
+        return labels, decision_scores.max(axis=1)
+
+# scaler.transform then pca.transform as one (projection, offset), x @ projection + offset
+def affine_preprocessing(scaler, pca):
+    # pca.transform(x) = (x - mean) @ components.T, divided by sqrt(explained variance) when whitened
+    projection = pca.components_.T
+    if getattr(pca, 'whiten', False):
+        projection = projection / np.sqrt(pca.explained_variance_)
+    offset = -pca.mean_ @ projection
+
+    # scaler.transform(x) = (x - mean) / scale
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(projection.shape[0])
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(projection.shape[0])
+    return projection / scale[:, None], offset - (mean / scale) @ projection
+
+# labels like svm.predict and max scores like decision_function_shape='ovr' from the one vs one
+# decision values of every pair of classes, in libsvm's pair order
+def vote(decisions, classes):
+    if len(classes) == 2:
+        decisions = decisions[:, 0]
+        return classes[(decisions > 0).astype(int)], decisions
+
+    # the class each pair votes for when its decision value is positive or not
+    n = len(classes)
+    first = np.array([i for i in range(n) for j in range(i + 1, n)])
+    second = np.array([j for i in range(n) for j in range(i + 1, n)])
+
+    rows = np.arange(len(decisions))[:, None]
+    votes = np.zeros((len(decisions), n))
+    np.add.at(votes, (rows, np.where(decisions > 0, first, second)), 1)
+
+    confidences = np.zeros_like(votes)
+    np.add.at(confidences, (rows, first), decisions)
+    np.add.at(confidences, (rows, second), -decisions)
+    ovr = votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    return classes[np.argmax(votes, axis=1)], ovr.max(axis=1)
+
+# scaler, pca and a linear svc are all affine, folded together they are one matrix multiply
+# giving the one vs one decision values
+class LinearScorer:
+    def __init__(self, weights, bias, classes):
+        self.weights = weights
+        self.bias = bias
+        self.classes = np.asarray(classes)
+
+    def score(self, features):
+        return vote(np.asarray(features, dtype=np.float64) @ self.weights + self.bias, self.classes)
+
+def rbf_kernel(a, b, gamma):
+    distances = (a * a).sum(axis=1)[:, None] + (b * b).sum(axis=1)[None, :] - 2 * a @ b.T
+    return np.exp(-gamma * np.maximum(distances, 0))
+
+# decision values that are linear in the rbf kernel values of a set of points, after the scaler and pca:
+# the support vectors of an rbf svc, or the landmarks of its approximation
+class KernelScorer:
+    def __init__(self, projection, offset, points, weights, bias, gamma, classes):
+        self.projection = projection
+        self.offset = offset
+        self.points = points
+        self.weights = weights
+        self.bias = bias
+        self.gamma = gamma
+        self.classes = np.asarray(classes)
+
+    def score(self, features):
+        reduced = np.asarray(features, dtype=np.float64) @ self.projection + self.offset
+        return vote(rbf_kernel(reduced, self.points, self.gamma) @ self.weights + self.bias, self.classes)
+
+def can_fuse(svm):
+    return getattr(svm, 'kernel', None) in ('linear', 'rbf') and getattr(svm, 'decision_function_shape', 'ovr') == 'ovr' and not getattr(svm, 'break_ties', False)
+
+# the arrays of the numpy scorer of a linear or rbf svc, { name: array } and the rbf gamma or None
+def scorer_arrays(svm, scaler, pca):
+    projection, offset = affine_preprocessing(scaler, pca)
+    arrays = {'projection': projection, 'offset': offset}
+
+    if svm.kernel == 'linear':
+        coef = np.asarray(svm.coef_.toarray() if hasattr(svm.coef_, 'toarray') else svm.coef_)
+        arrays['linear_weights'] = np.ascontiguousarray(projection @ coef.T)
+        arrays['linear_bias'] = offset @ coef.T + svm.intercept_
+        return arrays, None
+
+    # the exact one vs one decision values of an rbf svc, one kernel matrix times one weight matrix
+    dual_coef = np.asarray(svm.dual_coef_)
+    n = len(svm.classes_)
+    if n == 2:
+        # dual_coef_ and intercept_ already have the sign of decision_function here
+        weights = dual_coef[0][:, None]
+    else:
+        # libsvm layout: the support vectors are grouped by class, the coefficients of the vectors of
+        # class i against class j are in row j - 1 when i < j and in row j when i > j
+        starts = np.concatenate([[0], np.cumsum(svm.n_support_)])
+        weights = np.zeros((dual_coef.shape[1], n * (n - 1) // 2))
+        pair = 0
+        for i in range(n):
+            for j in range(i + 1, n):
+                weights[starts[i]:starts[i + 1], pair] = dual_coef[j - 1, starts[i]:starts[i + 1]]
+                weights[starts[j]:starts[j + 1], pair] = dual_coef[i, starts[j]:starts[j + 1]]
+                pair += 1
+
+    arrays['kernel_points'] = np.asarray(svm.support_vectors_, dtype=np.float64)
+    arrays['kernel_weights'] = weights
+    arrays['kernel_bias'] = np.asarray(svm.intercept_, dtype=np.float64)
+    return arrays, float(svm._gamma)
+
+# an rbf svc costs one kernel row per support vector and patch, the approximation keeps a fixed set of
+# landmarks (Nystroem) and a linear model on their kernel values, fitted to the svc's own one vs one
+# decision values, which are linear in the kernel values of the support vectors
+def fit_approximation(svm, scaler, pca, features, components=500, regularization=1e-6, seed=0):
+    if getattr(svm, 'kernel', None) != 'rbf':
+        raise ValueError(f'only rbf presets can be approximated, this one is {getattr(svm, "kernel", None)}')
+
+    reduced = pca.transform(scaler.transform(features))
+    one_vs_one = copy.copy(svm)
+    one_vs_one.decision_function_shape = 'ovo'
+    targets = np.asarray(one_vs_one.decision_function(reduced)).reshape(len(reduced), -1)
+    gamma = float(svm._gamma)
+
+    rng = np.random.default_rng(seed)
+    landmarks = reduced[rng.choice(len(reduced), min(components, len(reduced)), replace=False)]
+
+    # Nystroem map K(x, landmarks) @ K(landmarks, landmarks)^-1/2, the inverse root is folded into the weights
+    u, s, vt = np.linalg.svd(rbf_kernel(landmarks, landmarks, gamma))
+    normalization = (u / np.sqrt(np.maximum(s, 1e-12))) @ vt
+    mapped = rbf_kernel(reduced, landmarks, gamma) @ normalization.T
+
+    # ridge regression of the decision values, the bias column is not regularized
+    design = np.hstack([mapped, np.ones((len(mapped), 1))])
+    penalty = regularization * np.eye(design.shape[1])
+    penalty[-1, -1] = 0
+    solution = np.linalg.solve(design.T @ design + penalty, design.T @ targets)
+
+    return {
+        'kind': 'nystroem',
+        'gamma': gamma,
+        'landmarks': landmarks,
+        'weights': normalization.T @ solution[:-1],
+        'bias': solution[-1],
+        'classes': np.asarray(svm.classes_),
+    }
+
+def approximation_scorer(projection, offset, approximation):
+    return KernelScorer(projection, offset, approximation['landmarks'], approximation['weights'], approximation['bias'], approximation['gamma'], approximation['classes'])
+
+# agreement of the approximation with the preset on the given rows, and the speed of both
+def approximation_report(scorer, svm, scaler, pca, features):
+    reference = SklearnScorer(svm, scaler, pca)
+
+    start = time.perf_counter()
+    reference_labels, reference_scores = reference.score(features)
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labels, scores = scorer.score(features)
+    seconds = time.perf_counter() - start
+
+    differences = np.abs(scores - reference_scores)
+    return {
+        'patches': int(len(labels)),
+        'label_agreement': float(np.mean(labels == reference_labels)),
+        'max_score_difference': float(differences.max(initial=0.0)),
+        'mean_score_difference': float(differences.mean()) if len(differences) else 0.0,
+        'svm_ms_per_1000': 1e6 * reference_seconds / max(len(labels), 1),
+        'approximation_ms_per_1000': 1e6 * seconds / max(len(labels), 1),
+    }
+
+def fused_scoring_enabled():
+    return os.getenv("INSPECTION_CLIENT_FUSED_SCORING", "1") == "1"
+
+def approximation_enabled():
+    return os.getenv("INSPECTION_CLIENT_APPROXIMATION", "1") == "1"
+
+# metadata of the preset, a compiled approximation stored in it is used in place of the svm.
+# metadata['arrays'] (with 'gamma' and 'classes') are the scorer arrays the preset file already holds,
+# with them the sklearn objects are only needed for the fallback
+def compile_scorer(svm, scaler, pca, metadata=None):
+    metadata = metadata or {}
+    arrays = metadata.get('arrays')
+    gamma = metadata.get('gamma')
+    classes = metadata.get('classes')
+    if not arrays and can_fuse(svm):
+        arrays, gamma = scorer_arrays(svm, scaler, pca)
+        classes = svm.classes_
+
+    approximation = metadata.get('approximation')
+    if approximation is not None and approximation_enabled():
+        if arrays:
+            return approximation_scorer(arrays['projection'], arrays['offset'], approximation)
+        return approximation_scorer(*affine_preprocessing(scaler, pca), approximation)
+
+    if fused_scoring_enabled() and arrays:
+        if 'linear_weights' in arrays:
+            return LinearScorer(arrays['linear_weights'], arrays['linear_bias'], classes)
+        if 'kernel_weights' in arrays:
+            return KernelScorer(arrays['projection'], arrays['offset'], arrays['kernel_points'], arrays['kernel_weights'], arrays['kernel_bias'], gamma, classes)
+
+    return SklearnScorer(svm, scaler, pca)
+
+# largest label disagreement share and score difference between a scorer and the plain sklearn path
+def compare_with_sklearn(scorer, svm, scaler, pca, features):
+    labels, scores = scorer.score(features)
+    reference_labels, reference_scores = SklearnScorer(svm, scaler, pca).score(features)
+    return float(np.mean(labels != reference_labels)), float(np.max(np.abs(scores - reference_scores), initial=0.0))
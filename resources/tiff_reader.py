@@ -0,0 +1,86 @@
+import os
+import cv2
+import numpy as np
+from multiprocessing import cpu_count
+from resources.retry import retry_on_exception, read_image_with_retry
+from resources.log import LoggerSingleton
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+REDUCED_MODES = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# threads per process, so that all the cutting workers together use about all of the cores
+def decode_threads():
+    threads = int(os.getenv("INSPECTION_CLIENT_DECODE_THREADS", "0"))
+    if threads > 0:
+        return threads
+    workers = min(int(os.getenv("INSPECTION_CLIENT_MAX_CORES", str(cpu_count()))), cpu_count())
+    return max(1, cpu_count() // max(workers, 1))
+
+# same result as cv2.imread(path, cv2.IMREAD_GRAYSCALE): 8 bit, single channel
+def to_gray_uint8(image, photometric=None):
+    if image.dtype == np.bool_:
+        image = image.astype(np.uint8) * 255
+    elif image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    elif image.dtype != np.uint8:
+        image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    if image.ndim == 3:
+        if image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY)
+        elif image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            image = image[:, :, 0]
+
+    if photometric is not None and photometric == tifffile.PHOTOMETRIC.MINISWHITE:
+        image = 255 - image
+
+    return np.ascontiguousarray(image)
+
+def read_tiff(image_path, maxworkers=None):
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        if page.is_memmappable and page.compression == tifffile.COMPRESSION.NONE:
+            # uncompressed scans are mapped instead of copied through a decoder
+            image = tif.asarray(key=0, out='memmap')
+        else:
+            image = page.asarray(maxworkers=maxworkers or decode_threads())
+        return to_gray_uint8(image, page.photometric)
+
+# reduced resolution copy for the page boundary detection, uses a stored pyramid level if the tif has one
+# and otherwise a reduced decode, unless decoding the file a second time is not wanted
+def read_tiff_reduced(image_path, factor, allow_decode=True):
+    if tifffile is not None:
+        try:
+            with tifffile.TiffFile(image_path) as tif:
+                levels = tif.series[0].levels
+                full_width = levels[0].shape[1] if len(levels[0].shape) > 1 else None
+                for level in levels[1:]:
+                    if full_width and full_width // level.shape[1] == factor:
+                        return to_gray_uint8(level.asarray(maxworkers=decode_threads()), tif.pages[0].photometric)
+        except Exception as e:
+            LoggerSingleton().error('(Tiff-rtr) ' + str(e))
+
+    if allow_decode and factor in REDUCED_MODES:
+        return read_image_with_retry(image_path, REDUCED_MODES[factor])
+    return None
+
+@retry_on_exception
+def read_tiff_with_retry(image_path):
+    if tifffile is not None and image_path.lower().endswith(('.tif', '.tiff')):
+        try:
+            image = read_tiff(image_path)
+            if image.shape[0] > 0 and image.shape[1] > 0:
+                return image
+        except Exception as e:
+            LoggerSingleton().error('(Tiff-rtwr) ' + str(e))
+
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise Exception('image is none')
+    return image
@@ -0,0 +1,66 @@
+import os
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from resources.log import LoggerSingleton
+
+# pools for the whole application by kind, 'main' is shared by the cut and inspect stages of every folder
+_pools = {}
+
+# presets already loaded in this process, by preset name: (mtime, preset, scorer)
+_presets = {}
+
+def max_workers():
+    return min(int(os.getenv("INSPECTION_CLIENT_MAX_CORES")), cpu_count())
+
+def init_worker(preset_name=None):
+    # pay for the heavy imports once per worker instead of once per folder
+    import cv2
+    import sklearn.svm
+    import sklearn.decomposition
+    import skimage.feature
+    from resources import utils, svm, features
+
+    if preset_name:
+        try:
+            get_preset(preset_name)
+        except Exception as e:
+            print(f'(Pool-iw) {e}')
+            LoggerSingleton().error('(Pool-iw) ' + str(e))
+
+def preset_path(preset_name):
+    from resources.presets import preset_path
+    return preset_path(preset_name)
+
+# (svm, scaler, pca, metadata), a preset saved again under the same name is loaded again
+def get_preset(preset_name):
+    return _load_preset(preset_name)[1]
+
+# the scorer compiled from the preset, built once together with the preset
+def get_scorer(preset_name):
+    return _load_preset(preset_name)[2]
+
+def _load_preset(preset_name):
+    from resources.presets import load_preset_file, preset_mtime
+    from resources.scoring import compile_scorer
+
+    mtime = preset_mtime(preset_path(preset_name))
+    if preset_name not in _presets or _presets[preset_name][0] != mtime:
+        preset = load_preset_file(preset_path(preset_name))
+        _presets[preset_name] = (mtime, preset, compile_scorer(*preset))
+    return _presets[preset_name]
+
+def get_pool(preset_name=None, kind='main'):
+    pool = _pools.get(kind)
+    if pool is not None and getattr(pool, '_broken', False):
+        shutdown_pool(kind)
+        pool = None
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=max_workers(), initializer=init_worker, initargs=(preset_name,))
+        _pools[kind] = pool
+    return pool
+
+def shutdown_pool(kind=None):
+    for name in ([kind] if kind else list(_pools)):
+        pool = _pools.pop(name, None)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import resources
+
+# in a source checkout svm, utils and features are in protected_resources (build.bat moves them into
+# resources only for the build), look there before the compiled modules left in resources
+PROTECTED = os.path.join(ROOT, 'protected_resources')
+if os.path.isdir(PROTECTED):
+    resources.__path__.insert(0, PROTECTED)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from skimage.feature import graycomatrix, graycoprops
+
+from resources.feature_kernels import KERNELS, glcm_prop
+
+def skimage_prop(patch, prop):
+    glcm = graycomatrix(patch, [1], [0], 256, symmetric=True, normed=True)
+    return float(graycoprops(glcm, prop)[0, 0])
+
+@pytest.fixture
+def patches():
+    rng = np.random.default_rng(0)
+    patches = [rng.integers(0, 256, (200, 200), dtype=np.uint8) for _ in range(8)]
+    patches += [rng.integers(0, 256, (200, 200), dtype=np.uint8) // 32, rng.integers(0, 256, (37, 53), dtype=np.uint8)]
+    patches += [np.full((200, 200), value, dtype=np.uint8) for value in (0, 128, 255)]
+    patches += [np.tile(np.arange(200, dtype=np.uint8), (200, 1))]
+    return patches
+
+@pytest.mark.parametrize('prop', sorted(KERNELS))
+def test_kernel_matches_skimage(prop, patches):
+    for patch in patches:
+        assert float(glcm_prop(patch, prop)) == pytest.approx(skimage_prop(patch, prop), rel=1e-9, abs=1e-12)
+
+@pytest.mark.parametrize('prop', sorted(KERNELS))
+def test_stacked_patches_match_single(prop, patches):
+    stack = np.stack([patch for patch in patches if patch.shape == (200, 200)])
+    np.testing.assert_allclose(glcm_prop(stack, prop), [glcm_prop(patch, prop) for patch in stack], rtol=1e-12)
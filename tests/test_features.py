@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from resources.features import extract_features, extract_features_batch
+
+def reference(patch):
+    try:
+        return extract_features(patch)
+    except Exception as e:
+        return type(e)
+
+def batched(patch, neighbour):
+    try:
+        return extract_features_batch([neighbour, patch, neighbour])[1]
+    except Exception as e:
+        return type(e)
+
+@pytest.fixture
+def textured():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (200, 200), dtype=np.uint8)
+
+def test_batch_matches_reference(textured):
+    rng = np.random.default_rng(1)
+    patches = [textured] + [rng.integers(0, 256, (200, 200), dtype=np.uint8) // 4 for _ in range(3)]
+    for patch, row in zip(patches, extract_features_batch(patches)):
+        np.testing.assert_allclose(row, extract_features(patch), rtol=1e-7, atol=1e-9)
+
+# blank pages and black borders have no spectrum besides dc, whatever the per patch path gives for them
+# (a value or an error) the batch gives too
+@pytest.mark.parametrize('value', [0, 128, 255])
+def test_constant_patches_match_reference(value, textured):
+    patch = np.full((200, 200), value, dtype=np.uint8)
+    expected = reference(patch)
+    result = batched(patch, textured)
+    if isinstance(expected, type):
+        assert result is expected
+    else:
+        np.testing.assert_allclose(result, expected, rtol=1e-7, atol=1e-9)